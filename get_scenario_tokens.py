@@ -1,5 +1,6 @@
 import sqlite3
 import os
+from concurrent.futures import ProcessPoolExecutor
 from typing import Dict, List, Generator
 from nuplan.database.nuplan_db.nuplan_scenario_queries import (
     get_lidarpc_tokens_with_scenario_tag_from_db,
@@ -8,32 +9,9 @@ from nuplan.database.nuplan_db.nuplan_scenario_queries import (
 )
 from typing import Any, Dict, List, Optional, Tuple
 from collections import defaultdict
+from utils.db_connection import execute_many
 
 
-def execute_many(query_text: str, query_parameters: Any, db_file: str) -> Generator[sqlite3.Row, None, None]:
-    """
-    Runs a query with the provided arguments on a specified Sqlite DB file.
-    This query can return any number of rows.
-    :param query_text: The query to run.
-    :param query_parameters: The parameters to provide to the query.
-    :param db_file: The DB file on which to run the query.
-    :return: A generator of rows emitted from the query.
-    """
-    # Caching a connection saves around 600 uS for local databases.
-    # By making it stateless, we get isolation, which is a huge plus.
-    connection = sqlite3.connect(db_file)
-    connection.row_factory = sqlite3.Row
-    cursor = connection.cursor()
-
-    try:
-        cursor.execute(query_text, query_parameters)
-
-        for row in cursor:
-            yield row
-    finally:
-        cursor.close()
-        connection.close()
-
 def get_scenario_info_from_db(db_file: str) -> Dict[str, List[str]]:
     """
     Get the scenario types and their corresponding scenario tokens from a single database file.
@@ -58,23 +36,83 @@ def get_scenario_info_from_db(db_file: str) -> Dict[str, List[str]]:
 
     return scenario_info
 
-def get_scenario_info_from_all_dbs(db_dir: str, db_files: List[str]) -> Dict[str, Dict[str, List[str]]]:
+def _scan_db_file(db_path: str) -> Tuple[str, Optional[Dict[str, List[str]]], Optional[str]]:
     """
-    Get scenario types and tokens from all `.db` files in the specified directory.
+    Worker entry point for the process pool: scan a single `.db` file and never raise.
+    :param db_path: Path to the SQLite database file.
+    :return: A (db_path, scenario_info, error) tuple, where exactly one of scenario_info/error is None.
+    """
+    try:
+        return db_path, get_scenario_info_from_db(db_path), None
+    except Exception as e:
+        return db_path, None, f"{type(e).__name__}: {e}"
+
+def scan_scenario_info_from_all_dbs(
+    db_dir: str,
+    db_files: List[str],
+    num_workers: int = 1,
+    chunksize: int = 1,
+) -> Tuple[Dict[str, Dict[str, List[str]]], Dict[str, str]]:
+    """
+    Get scenario types and tokens from all `.db` files, optionally fanning out over a process pool.
+    A file that fails to open or query is recorded and skipped, the rest of the sweep continues.
     :param db_dir: Directory containing the database files.
     :param db_files: List of `.db` files to process.
-    :return: A nested dictionary where keys are database file names and values are dictionaries
-             with scenario types and corresponding tokens.
+    :param num_workers: Number of worker processes, 1 scans sequentially in the current process.
+    :param chunksize: Number of files handed to a worker at a time.
+    :return: A tuple of (all_scenario_info, failures). all_scenario_info is the same nested dictionary as
+             `get_scenario_info_from_all_dbs`, ordered like `db_files`; failures maps db file names to errors.
     """
-    all_scenario_info = {}
-
+    db_paths = {}
     for db_file in db_files:
         db_path = os.path.join(db_dir, db_file)
         if os.path.isfile(db_path) and db_file.endswith(".db"):
-            print(f"Processing file: {db_file}")
-            scenario_info = get_scenario_info_from_db(db_path)
-            all_scenario_info[db_file] = scenario_info
+            db_paths[db_path] = db_file
+
+    if num_workers > 1:
+        executor = ProcessPoolExecutor(max_workers=num_workers)
+        results = executor.map(_scan_db_file, list(db_paths), chunksize=max(1, chunksize))
+    else:
+        executor = None
+        results = map(_scan_db_file, db_paths)
 
+    scanned = {}
+    failures = {}
+    try:
+        for idx, (db_path, scenario_info, error) in enumerate(results, start=1):
+            db_file = db_paths[db_path]
+            if error is not None:
+                failures[db_file] = error
+                print(f"[{idx}/{len(db_paths)}] Failed file: {db_file} ({error})")
+            else:
+                scanned[db_file] = scenario_info
+                print(f"[{idx}/{len(db_paths)}] Processed file: {db_file}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # Merge in input order so the result does not depend on worker scheduling
+    all_scenario_info = {db_file: scanned[db_file] for db_file in db_paths.values() if db_file in scanned}
+    if failures:
+        print(f"{len(failures)} of {len(db_paths)} files failed: {sorted(failures)}")
+    return all_scenario_info, failures
+
+def get_scenario_info_from_all_dbs(
+    db_dir: str,
+    db_files: List[str],
+    num_workers: int = 1,
+    chunksize: int = 1,
+) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Get scenario types and tokens from all `.db` files in the specified directory.
+    :param db_dir: Directory containing the database files.
+    :param db_files: List of `.db` files to process.
+    :param num_workers: Number of worker processes, 1 scans sequentially in the current process.
+    :param chunksize: Number of files handed to a worker at a time.
+    :return: A nested dictionary where keys are database file names and values are dictionaries
+             with scenario types and corresponding tokens.
+    """
+    all_scenario_info, _ = scan_scenario_info_from_all_dbs(db_dir, db_files, num_workers, chunksize)
     return all_scenario_info
 
 # Example usage
@@ -83,8 +121,8 @@ if __name__ == "__main__":
     db_directory = os.path.join(os.environ["NUPLAN_DATA_ROOT"], "nuplan-v1.1/trainval")
     # List of `.db` files to process (could be filtered from os.listdir if needed)
     db_files = [file for file in os.listdir(db_directory) if file.endswith(".db")]
-    # Get scenario information from all `.db` files
-    all_scenarios = get_scenario_info_from_all_dbs(db_directory, db_files)
+    # Get scenario information from all `.db` files, one worker per core
+    all_scenarios = get_scenario_info_from_all_dbs(db_directory, db_files, num_workers=os.cpu_count() or 1, chunksize=8)
 
     # # # Print the results
     for db_file, scenario_data in all_scenarios.items():
@@ -1,112 +1,302 @@
 import os
 import numpy as np
 import pandas as pd
-import torch
-import torch.nn.functional as F
-from scipy.stats import entropy
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Dict, List, Sequence
 from omegaconf import DictConfig  # Assuming DictConfig is from `omegaconf`
 
+OOD_AGGREGATIONS = ('avg', 'max', 'min', 'std', 'var')
+
+def aggregate_segments(
+    values: np.ndarray, lengths: np.ndarray, stats: Sequence[str] = OOD_AGGREGATIONS
+) -> Dict[str, np.ndarray]:
+    """
+    Reduce consecutive segments of a flat array, e.g. the per-array scores of every report row.
+    :param values: Flat array of values.
+    :param lengths: Length of every segment, zero-length segments get NaN.
+    :param stats: Any of `avg`, `max`, `min`, `std`, `var` (population std/var, like np.std/np.var).
+    :return: A dictionary mapping each stat to an array with one value per segment.
+    """
+    nonempty = lengths > 0
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))[nonempty]
+    counts = lengths[nonempty]
+    reduced = {}
+    if len(counts):
+        mean = np.add.reduceat(values, starts) / counts
+        reduced['avg'] = mean
+        reduced['max'] = np.maximum.reduceat(values, starts)
+        reduced['min'] = np.minimum.reduceat(values, starts)
+        if 'std' in stats or 'var' in stats:
+            # Infinite scores (e.g. entropy of negative logits) give NaN spreads rather than warnings
+            with np.errstate(invalid='ignore'):
+                centered = values - np.repeat(mean, counts)
+                reduced['var'] = np.add.reduceat(centered * centered, starts) / counts
+            reduced['std'] = np.sqrt(reduced['var'])
+
+    result = {}
+    for stat in stats:
+        if stat not in OOD_AGGREGATIONS:
+            raise ValueError(f"Unsupported aggregation: {stat}. Choose from {OOD_AGGREGATIONS}.")
+        column = np.full(len(lengths), np.nan)
+        if len(counts):
+            column[nonempty] = reduced[stat]
+        result[stat] = column
+    return result
+
+class RaggedScores:
+    def __init__(self, column: pd.Series):
+        """
+        Pack a column whose cells are sequences of logit arrays into one flat float64 buffer with offsets,
+        so every per-array score is a handful of segmented NumPy reductions instead of Python loops.
+        :param column: Column of the report holding the logits, e.g. `risk_score`.
+        """
+        arrays = []
+        row_lengths = []
+        for cell in column:
+            row_lengths.append(len(cell))
+            arrays.extend(np.asarray(array, dtype=np.float64).ravel() for array in cell)
+
+        array_lengths = np.fromiter((len(array) for array in arrays), dtype=np.int64, count=len(arrays))
+        if (array_lengths == 0).any():
+            raise ValueError("Cannot score empty logit arrays.")
+        self.values = np.concatenate(arrays) if arrays else np.empty(0, dtype=np.float64)
+        self.array_lengths = array_lengths
+        # Start offset of every array in `values`, and of every row in the per-array scores
+        self.array_starts = np.concatenate(([0], np.cumsum(array_lengths)[:-1])).astype(np.int64)
+        self.row_lengths = np.asarray(row_lengths, dtype=np.int64)
+        # Intermediates shared between scores, e.g. the max is used by msp, energy and max-minus-mean
+        self._cache = {}
+
+    def _cached(self, key, compute):
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+    def segment_sum(self, values: np.ndarray) -> np.ndarray:
+        if len(self.array_lengths) == 0:
+            return np.empty(0, dtype=np.float64)
+        return np.add.reduceat(values, self.array_starts)
+
+    def segment_max(self) -> np.ndarray:
+        def compute():
+            if len(self.array_lengths) == 0:
+                return np.empty(0, dtype=np.float64)
+            return np.maximum.reduceat(self.values, self.array_starts)
+        return self._cached('max', compute)
+
+    def broadcast(self, per_array: np.ndarray) -> np.ndarray:
+        """
+        Repeat a per-array value for every element of the array, to line up with `values`.
+        """
+        return np.repeat(per_array, self.array_lengths)
+
+    def mean(self) -> np.ndarray:
+        return self._cached('mean', lambda: self.segment_sum(self.values) / self.array_lengths)
+
+    def var(self) -> np.ndarray:
+        def compute():
+            centered = self.values - self.broadcast(self.mean())
+            return self.segment_sum(centered * centered) / self.array_lengths
+        return self._cached('var', compute)
+
+    def sum_exp_shifted(self) -> np.ndarray:
+        # sum(exp(x - max)) lies in [1, n], so it neither overflows nor underflows to zero
+        return self._cached(
+            'sum_exp_shifted',
+            lambda: self.segment_sum(np.exp(self.values - self.broadcast(self.segment_max()))),
+        )
+
+    def energy(self) -> np.ndarray:
+        # logsumexp: log(sum(exp(x))) = max + log(sum(exp(x - max)))
+        return self._cached('energy', lambda: self.segment_max() + np.log(self.sum_exp_shifted()))
+
+    def exp_mean(self) -> np.ndarray:
+        # log(mean(exp(x))) = logsumexp(x) - log(n)
+        return self.energy() - np.log(self.array_lengths)
+
+    def msp(self) -> np.ndarray:
+        # max(softmax(x)) = exp(max - max) / sum(exp(x - max))
+        return 1.0 / self.sum_exp_shifted()
+
+    def plus(self) -> np.ndarray:
+        return self.var() + self.mean()
+
+    def max_minus_mean(self) -> np.ndarray:
+        return self.segment_max() - self.mean()
+
+    def entropy(self) -> np.ndarray:
+        # Same as scipy.stats.entropy: normalize to sum 1, -p*log(p) with 0 for p == 0 and -inf for p < 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            p = self.values / self.broadcast(self.segment_sum(self.values))
+            entr = np.where(p > 0, -p * np.log(np.where(p > 0, p, 1.0)), np.where(p == 0, 0.0, -np.inf))
+        return self.segment_sum(entr)
+
+    def split_rows(self, per_array: np.ndarray) -> np.ndarray:
+        """
+        Regroup per-array scores by report row.
+        :return: An object array holding one score array per row.
+        """
+        rows = np.empty(len(self.row_lengths), dtype=object)
+        for idx, row in enumerate(np.split(per_array, np.cumsum(self.row_lengths)[:-1])):
+            rows[idx] = row
+        return rows
+
 class ComputePostScore:
+    SCORES = {
+        'energy': RaggedScores.energy,
+        'msp': RaggedScores.msp,
+        'mean': RaggedScores.mean,
+        'exp_mean': RaggedScores.exp_mean,
+        'var': RaggedScores.var,
+        'plus': RaggedScores.plus,
+        'min': RaggedScores.max_minus_mean,
+        'entropy': RaggedScores.entropy,
+    }
+
     def __init__(self, df: pd.DataFrame, cfg: DictConfig):
         self.df = df
         self.post_score = cfg.post_score  # Config key for score column
+        self._ragged = None
 
-    def get_energy_score(self) -> pd.DataFrame:
-        ood_score = []
-        for i in self.df[self.post_score]:
-            # Compute raw ood_score as the log sum of exponentials for each array
-            raw_ood_score = [np.log(np.sum(np.exp(j))) for j in i]
-            ood_score.append(raw_ood_score)
-        self.df['score'] = ood_score
+    @property
+    def ragged(self) -> RaggedScores:
+        # Packed once and shared by all score methods
+        if self._ragged is None:
+            self._ragged = RaggedScores(self.df[self.post_score])
+        return self._ragged
+
+    def _set_score(self, per_array: np.ndarray) -> pd.DataFrame:
+        self.df['score'] = self.ragged.split_rows(per_array)
         return self.df
 
-    def get_msp_score(self) -> pd.DataFrame:
-        ood_score = []
-        for i in self.df[self.post_score]:
-            # Compute the maximum softmax probability for each array
-            raw_score = [np.max(F.softmax(torch.tensor(x), dim=0).numpy()) for x in i]
-            ood_score.append(raw_score)
-        self.df['score'] = ood_score
+    def compute_scores(self, scores: List[str], aggregations: Sequence[str] = OOD_AGGREGATIONS) -> pd.DataFrame:
+        """
+        Compute several post scores in one pass over the packed logits, sharing intermediates between them.
+        Each score `<name>` is written to its own `<name>_score` column (one array per row), and its
+        per-row aggregations to `<name>_ood_score_<avg|max|min|std|var>` columns.
+        :param scores: Names of the scores, keys of `SCORES`.
+        :param aggregations: Per-row aggregations to compute for every score.
+        :return: The updated DataFrame.
+        """
+        unknown = [name for name in scores if name not in self.SCORES]
+        if unknown:
+            raise ValueError(f"Unsupported scores: {unknown}. Choose from {list(self.SCORES)}.")
+        for name in scores:
+            per_array = self.SCORES[name](self.ragged)
+            self.df[f'{name}_score'] = self.ragged.split_rows(per_array)
+            for stat, column in aggregate_segments(per_array, self.ragged.row_lengths, aggregations).items():
+                self.df[f'{name}_ood_score_{stat}'] = column
         return self.df
 
-    def get_mean_score(self) -> pd.DataFrame:
-        ood_score = []
-        for i in self.df[self.post_score]:
-            # Compute the mean for each array
-            raw_ood_score = [np.mean(j) for j in i]
-            ood_score.append(raw_ood_score)
-        self.df['score'] = ood_score
+    def _aggregate_score(self, stat: str) -> pd.DataFrame:
+        cells = self.df['score']
+        lengths = np.fromiter((len(cell) for cell in cells), dtype=np.int64, count=len(cells))
+        values = np.concatenate([np.asarray(cell, dtype=np.float64).ravel() for cell in cells] or [np.empty(0)])
+        self.df[f'ood_score_{stat}'] = aggregate_segments(values, lengths, [stat])[stat]
         return self.df
 
+    def get_energy_score(self) -> pd.DataFrame:
+        # Compute raw ood_score as the log sum of exponentials for each array
+        return self._set_score(self.ragged.energy())
+
+    def get_msp_score(self) -> pd.DataFrame:
+        # Compute the maximum softmax probability for each array
+        return self._set_score(self.ragged.msp())
+
+    def get_mean_score(self) -> pd.DataFrame:
+        # Compute the mean for each array
+        return self._set_score(self.ragged.mean())
+
     def get_exp_mean_score(self) -> pd.DataFrame:
-        ood_score = []
-        for i in self.df[self.post_score]:
-            # Compute the exponential mean for each array
-            raw_ood_score = [np.log(np.mean(np.exp(j))) for j in i]
-            ood_score.append(raw_ood_score)
-        self.df['score'] = ood_score
-        return self.df
+        # Compute the exponential mean for each array
+        return self._set_score(self.ragged.exp_mean())
 
     def get_var_score(self) -> pd.DataFrame:
-        ood_score = []
-        for i in self.df[self.post_score]:
-            # Compute the variance for each array
-            raw_ood_score = [np.var(j) for j in i]
-            ood_score.append(raw_ood_score)
-        self.df['score'] = ood_score
-        return self.df
+        # Compute the variance for each array
+        return self._set_score(self.ragged.var())
 
     def get_plus_score(self) -> pd.DataFrame:
-        ood_score = []
-        for i in self.df[self.post_score]:
-            # Compute the sum of variance and mean for each array
-            raw_ood_score = [(np.var(j) + np.mean(j)) for j in i]
-            ood_score.append(raw_ood_score)
-        self.df['score'] = ood_score
-        return self.df
+        # Compute the sum of variance and mean for each array
+        return self._set_score(self.ragged.plus())
 
     def get_min_score(self) -> pd.DataFrame:
-        ood_score = []
-        for i in self.df[self.post_score]:
-            # Compute the difference between max and mean for each array
-            raw_ood_score = [(np.max(j) - np.mean(j)) for j in i]
-            ood_score.append(raw_ood_score)
-        self.df['score'] = ood_score
-        return self.df
+        # Compute the difference between max and mean for each array
+        return self._set_score(self.ragged.max_minus_mean())
 
     def get_entropy_score(self) -> pd.DataFrame:
-        ood_score = []
-        for i in self.df[self.post_score]:
-            # Compute entropy for each array
-            raw_ood_score = [entropy(j) for j in i]
-            ood_score.append(raw_ood_score)
-        self.df['score'] = ood_score
-        return self.df
+        # Compute entropy for each array
+        return self._set_score(self.ragged.entropy())
 
     def calculate_average_ood_score(self) -> pd.DataFrame:
         # Compute mean of scores
-        self.df['ood_score_avg'] = self.df['score'].apply(lambda x: np.mean(x))
-        return self.df
+        return self._aggregate_score('avg')
 
     def calculate_max_ood_score(self) -> pd.DataFrame:
         # Compute max of scores
-        self.df['ood_score_max'] = self.df['score'].apply(lambda x: np.max(x))
-        return self.df
+        return self._aggregate_score('max')
 
     def calculate_min_ood_score(self) -> pd.DataFrame:
         # Compute min of scores
-        self.df['ood_score_min'] = self.df['score'].apply(lambda x: np.min(x))
-        return self.df
+        return self._aggregate_score('min')
 
     def calculate_std_ood_score(self) -> pd.DataFrame:
         # Compute standard deviation of scores
-        self.df['ood_score_std'] = self.df['score'].apply(lambda x: np.std(x))
-        return self.df
+        return self._aggregate_score('std')
 
     def calculate_var_ood_score(self) -> pd.DataFrame:
         # Compute variance of scores
-        self.df['ood_score_var'] = self.df['score'].apply(lambda x: np.var(x))
-        return self.df
+        return self._aggregate_score('var')
+
+
+def stream_post_scores(
+    cfg: DictConfig,
+    output_path: str,
+    scores: Sequence[str] = ('energy',),
+    aggregations: Sequence[str] = OOD_AGGREGATIONS,
+    batch_size: int = 10_000,
+    keep_score_arrays: bool = False,
+) -> int:
+    """
+    Score a runner report that does not fit in memory: read `runner_report.parquet` in record batches,
+    compute the post scores and their per-scenario aggregates batch by batch and append them to `output_path`.
+    Peak memory is bounded by `batch_size` rows.
+    :param cfg: Config with `runner_report_dir`, `runner_columns` and `post_score`.
+    :param output_path: Path of the Parquet file to write.
+    :param scores: Names of the scores, keys of `ComputePostScore.SCORES`.
+    :param aggregations: Per-scenario aggregations to compute for every score.
+    :param batch_size: Number of report rows scored at a time.
+    :param keep_score_arrays: Whether to also write the logits and per-array score columns.
+    :return: The number of scored rows.
+    """
+    runner_report = os.path.join(cfg.runner_report_dir, 'runner_report.parquet')
+    if not os.path.exists(runner_report):
+        raise FileNotFoundError(f"File {runner_report} does not exist.")
+    parquet_file = pq.ParquetFile(runner_report)
+    columns = list(dict.fromkeys([*(cfg.runner_columns or []), cfg.post_score]))
+    missing = [column for column in columns if column not in parquet_file.schema_arrow.names]
+    if missing:
+        raise ValueError(f"One or more specified columns {missing} do not exist in runner_report.")
+
+    num_rows = 0
+    writer = None
+    try:
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+            df = ComputePostScore(batch.to_pandas(), cfg).compute_scores(list(scores), aggregations)
+            if not keep_score_arrays:
+                df = df.drop(columns=[cfg.post_score, *[f'{name}_score' for name in scores]])
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(output_path, table.schema)
+            else:
+                table = table.cast(writer.schema)
+            writer.write_table(table)
+            num_rows += len(df)
+            print(f"Scored {num_rows}/{parquet_file.metadata.num_rows} rows")
+    finally:
+        if writer is not None:
+            writer.close()
+    return num_rows
 
 
 if __name__ == "__main__":
@@ -120,4 +310,4 @@ if __name__ == "__main__":
         cfg
     )
     # Read and merge all data
-    result_df = processor.read_metric_reports()
+    result_df = processor.load_merged_report()
@@ -2,27 +2,29 @@ import numpy as np
 import os
 import torch
 import pandas as pd
+try:
+    from feature_store import FeatureStore, iter_feature_files
+except ImportError:
+    # Imported as inference.compute_test_features, e.g. from the notebooks at the repository root
+    from .feature_store import FeatureStore, iter_feature_files
 
 os.environ['PLANTF'] = '/home/sgwang/planTF'
 
-def load_scenario_features(folder_path):
-    # Load encoder features from a folder
+def load_scenario_features(folder_path, store_path=None, **loader_kwargs):
+    # Load encoder features from a folder, or from a store packed by feature_store.build_feature_store
+    if store_path is not None and os.path.exists(store_path):
+        store = FeatureStore(store_path)
+        return [{scenario_name: store[scenario_name]} for scenario_name in store]
+    # The arrays are materialized in the workers, so no file handle is left open per scenario
     scenarios = []
-    for file_name in os.listdir(folder_path):
-        if file_name.endswith('.npz'):
-            file_path = os.path.join(folder_path, file_name)
-            scenario_name = file_name.split('.')[0]
-            try:
-                scenario = np.load(file_path)
-                scenarios.append({scenario_name:scenario})
-            except Exception as e:
-                print(f"Failed to load {file_path}: {e}")
+    for scenario_name, scenario in iter_feature_files(folder_path, '.npz', **loader_kwargs):
+        scenarios.append({scenario_name:scenario})
     return scenarios
 
 def get_array_features(scenario):
     "return array features of one scenario"
     array_features = []
-    for array_name in scenario.files:
+    for array_name in scenario:
         array_features.append(scenario[array_name])
     return array_features
 
@@ -38,7 +40,7 @@ def get_ego_features(features):
 def main():
     plantf_path = os.getenv('PLANTF')
     scenario_path = os.path.join(plantf_path, 'encoder_features')
-    scenarios =load_scenario_features(scenario_path)
+    scenarios =load_scenario_features(scenario_path, failure_report_path=scenario_path + '.failures.json')
     first_scenario = scenarios[0]
     scenario = list(first_scenario.values())[0]
     array_features = get_array_features(scenario)
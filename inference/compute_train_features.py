@@ -1,30 +1,42 @@
 import os
+import argparse
+import json
 import torch
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 import torch.nn as nn
 from sklearn.mixture import GaussianMixture
+from feature_store import PT_ARRAY_NAME, FeatureStore, fingerprint_features, iter_feature_files, load_pt_arrays
+from feature_statistics import OnlineCovariance, MahalanobisScorer, ClassConditionalMahalanobisScorer
+from performance_statistics import load_scenario_types
 from compute_test_features import load_scenario_features, get_array_features, get_ego_features
 from scipy.spatial import distance
-from sklearn.preprocessing import StandardScaler
 os.environ['PLANTF'] = '/home/sgwang/planTF'
 class EncoderFeatureAnalyzer:
     def __init__(self, dim):
         self.norm = nn.LayerNorm(dim)
         
-    def load_encoder_features(self, folder_path):
-        encoder_features = []
-        
-        for file_name in os.listdir(folder_path):
-            if file_name.endswith('.pt'):
-                file_path = os.path.join(folder_path, file_name)
-                try:
-                    features = torch.load(file_path)
-                    encoder_features.append(features)
-                except Exception as e:
-                    print(f"Failed to load {file_path}: {e}")
+    def iter_named_encoder_features(self, folder_path, store_path=None, **loader_kwargs):
+        if store_path is not None and os.path.exists(store_path):
+            # Copy-on-write views of the packed store, wrapped as tensors without copying
+            store = FeatureStore(store_path, mmap_mode='c')
+            for scenario_name in store:
+                yield scenario_name, torch.from_numpy(store.get_array(scenario_name))
+            return
+        # Unpickling holds the GIL, so .pt files are read in a process pool. Workers return numpy arrays:
+        # tensors would be sent back through shared memory, leaking a file descriptor each
+        for scenario_name, arrays in iter_feature_files(
+            folder_path, '.pt', load_pt_arrays, use_processes=True, **loader_kwargs
+        ):
+            yield scenario_name, torch.from_numpy(arrays[PT_ARRAY_NAME])
+
+    def iter_encoder_features(self, folder_path, store_path=None, **loader_kwargs):
+        for _, features in self.iter_named_encoder_features(folder_path, store_path, **loader_kwargs):
+            yield features
 
-        return encoder_features
+    def load_encoder_features(self, folder_path, store_path=None, **loader_kwargs):
+        return list(self.iter_encoder_features(folder_path, store_path, **loader_kwargs))
     
     def get_ego_features(self, features):
         ego_features = []
@@ -34,16 +46,16 @@ class EncoderFeatureAnalyzer:
         return ego_features
     
     def split_and_concat_features(self, features):
-        # Convert to tensor
-        # Split the tensor into a list of tensors each of size [128]
-        all_features = []
-        for feature in features:
-            split_features = feature.split(1, dim=0)
-            split_features = [f.squeeze(0) for f in split_features]
-            all_features.extend(split_features)
-        # Concatenate all tensors together as [:, 128]
-        concatenated_features = torch.stack(all_features)
+        # Concatenate all tensors together as [:, 128], in one copy
+        concatenated_features = torch.cat(list(features), dim=0)
         return concatenated_features
+
+    def accumulate_ego_moments(self, features):
+        # Streaming mean/covariance of the ego features, without stacking them in memory
+        moments = OnlineCovariance(self.norm.normalized_shape[0])
+        for feature in features:
+            moments.update(feature[:,0])
+        return moments
     
     def get_other_features(self, features):
         other_features = []
@@ -112,6 +124,26 @@ class EncoderFeatureAnalyzer:
         print("NaN in inv_cov_matrix:", np.isnan(inv_cov_matrix).any())
         return mean, cov_matrix, inv_cov_matrix
 
+    def accumulate_class_ego_moments(self, named_features, scenario_types, ind_scenario_types):
+        """
+        Streaming mean/covariance of the ego features of every in-distribution scenario type.
+        :param named_features: Iterable of (scenario name, features), e.g. from iter_named_encoder_features.
+        :param scenario_types: Dict {scenario name: scenario type}.
+        :param ind_scenario_types: In-distribution scenario types, e.g. loaded from InD.yaml.
+        :return: Dict {scenario type: OnlineCovariance}, scenarios of other or unknown types are skipped.
+        """
+        dim = self.norm.normalized_shape[0]
+        class_moments = {scenario_type: OnlineCovariance(dim) for scenario_type in sorted(ind_scenario_types)}
+        num_skipped = 0
+        for scenario_name, feature in named_features:
+            scenario_type = scenario_types.get(scenario_name)
+            if scenario_type not in class_moments:
+                num_skipped += 1
+                continue
+            class_moments[scenario_type].update(feature[:,0])
+        print(f"Skipped {num_skipped} scenarios without an InD scenario type")
+        return class_moments
+
     def calculate_mahalanobis_distance(self,new_sample,mean,inv_cov_matrix):
         print("NaN in new_sample:", np.isnan(new_sample).any())
         print("Inf in new_sample:", np.isinf(new_sample).any())
@@ -119,32 +151,70 @@ class EncoderFeatureAnalyzer:
         mahalanobis_dist = distance.mahalanobis(new_sample, mean, inv_cov_matrix)
         return mahalanobis_dist
     
-def main():
+def main(class_conditional=False):
     dim = 128
     analyzer = EncoderFeatureAnalyzer(dim)
     plantf_path = os.getenv('PLANTF')
     norm_path = os.path.join(plantf_path, 'inference_x')
-    norm_features = analyzer.load_encoder_features(norm_path)
-    norm_features = analyzer.get_ego_features(norm_features)
-    concatenated_features = analyzer.split_and_concat_features(norm_features)
-    
+    if class_conditional:
+        # One Gaussian per InD scenario type with a tied covariance, scored by the closest type
+        scorer_class = ClassConditionalMahalanobisScorer
+        scorer_path = os.path.join(plantf_path, 'class_mahalanobis_scorer.npz')
+        scenario_types_path = os.path.join(plantf_path, 'scenario_types.csv')
+        ind_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'InD.yaml')
+        label_paths = [scenario_types_path, ind_path]
+    else:
+        scorer_class = MahalanobisScorer
+        scorer_path = os.path.join(plantf_path, 'mahalanobis_scorer.npz')
+        label_paths = []
+    # The saved scorer is only reused if it was fitted on the same features (and labels) with the same model
+    fingerprint = json.dumps({
+        'scorer_type': scorer_class.__name__,
+        'features': fingerprint_features(norm_path, norm_path + '.npy', '.pt'),
+        'labels': [[os.path.basename(path), os.stat(path).st_mtime_ns, os.stat(path).st_size] for path in label_paths],
+    }, sort_keys=True)
+
+    scorer = scorer_class.load_if_fresh(scorer_path, fingerprint)
+    if scorer is None and class_conditional:
+        # scenario_name -> scenario_type of the training features, e.g. from the runner report
+        scenario_types = pd.read_csv(scenario_types_path)
+        scenario_types = dict(zip(scenario_types['scenario_name'], scenario_types['scenario_type']))
+        ind_scenario_types = load_scenario_types(ind_path)
+        named_features = analyzer.iter_named_encoder_features(
+            norm_path, norm_path + '.npy', failure_report_path=norm_path + '.failures.json', skip_failed=True
+        )
+        scorer = ClassConditionalMahalanobisScorer.fit(
+            analyzer.accumulate_class_ego_moments(named_features, scenario_types, ind_scenario_types)
+        )
+        scorer.save(scorer_path, fingerprint)
+    elif scorer is None:
+        norm_features = analyzer.iter_encoder_features(
+            norm_path, norm_path + '.npy', failure_report_path=norm_path + '.failures.json', skip_failed=True
+        )
+        scorer = MahalanobisScorer.fit(analyzer.accumulate_ego_moments(norm_features))
+        scorer.save(scorer_path, fingerprint)
+
     scenario_path = os.path.join(plantf_path, 'encoder_features')
-    scenarios =load_scenario_features(scenario_path)
-    first_scenario = scenarios[2]
-    scenario = list(first_scenario.values())[0]
-    array_features = get_array_features(scenario)
-    ego_features = get_ego_features(array_features)
-    
-    scaler = StandardScaler()
-    features_normalized = scaler.fit_transform(concatenated_features.numpy())
-    mean, cov_matrix, inv_cov_matrix = analyzer.calculate_matrix_feature(features_normalized)
-    for ego_feature in ego_features[:1]:
-        ego_feature = scaler.transform(ego_feature.reshape(1, -1)).flatten()
-        diff =ego_feature - mean
-        print("NaN in diff:", np.isnan(diff).any())
-        m = np.dot(np.dot(diff, inv_cov_matrix), diff.T)  # Quadratic form
-        print("Value of m:", m)
-        # dist = analyzer.calculate_mahalanobis_distance(ego_feature, mean, inv_cov_matrix)
-        # print(f'Mahalanobis Distance: {dist}')
+    scenarios =load_scenario_features(
+        scenario_path, scenario_path + '.npy', failure_report_path=scenario_path + '.failures.json', skip_failed=True
+    )
+    # Score the ego features of all test scenarios in one batch
+    scenario_names = []
+    ego_features = []
+    for scenario_entry in scenarios:
+        scenario_name, scenario = list(scenario_entry.items())[0]
+        for ego_feature in get_ego_features(get_array_features(scenario)):
+            ego_feature = np.asarray(ego_feature).reshape(-1, dim)
+            scenario_names.extend([scenario_name] * len(ego_feature))
+            ego_features.append(ego_feature)
+    distances = scorer.score(np.concatenate(ego_features))
+    print(f"Mahalanobis distance of {len(distances)} ego features: "
+          f"mean {np.nanmean(distances):.3f}, max {np.nanmax(distances):.3f}")
+    return scenario_names, distances
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Score the test ego features by Mahalanobis distance to the InD features.")
+    parser.add_argument("--class_conditional", action="store_true",
+                        help="Fit one mean per InD scenario type with a tied covariance, scored by the closest type."
+    )
+    args = parser.parse_args()
+    main(class_conditional=args.class_conditional)
\ No newline at end of file
@@ -0,0 +1,294 @@
+import os
+import numpy as np
+from scipy.linalg import solve_triangular
+
+
+class OnlineCovariance:
+    """
+    Streaming mean and covariance of feature vectors (Welford, with Chan's parallel update for batches).
+    Memory is O(dim^2) whatever the number of samples, and partial states computed by separate workers
+    can be combined with `merge`.
+    """
+
+    def __init__(self, dim, dtype=np.float64):
+        """
+        :param dim: Dimension of the feature vectors.
+        :param dtype: Accumulation dtype, float64 keeps the covariance accurate over millions of samples.
+        """
+        self.dim = dim
+        self.count = 0
+        self.mean = np.zeros(dim, dtype=dtype)
+        # Sum of outer products of the deviations from the mean
+        self.m2 = np.zeros((dim, dim), dtype=dtype)
+
+    def update(self, batch):
+        """
+        Add a batch of samples.
+        :param batch: Array (or tensor) of shape (num_samples, dim).
+        :return: self
+        """
+        batch = np.asarray(batch, dtype=self.mean.dtype).reshape(-1, self.dim)
+        if len(batch) == 0:
+            return self
+        batch_mean = batch.mean(axis=0)
+        deviations = batch - batch_mean
+        return self._combine(len(batch), batch_mean, deviations.T @ deviations)
+
+    def merge(self, other):
+        """
+        Add the samples accumulated by another instance.
+        :param other: OnlineCovariance of the same dimension.
+        :return: self
+        """
+        if other.dim != self.dim:
+            raise ValueError(f"Cannot merge a dim {other.dim} accumulator into a dim {self.dim} one.")
+        if other.count == 0:
+            return self
+        return self._combine(other.count, other.mean, other.m2)
+
+    def _combine(self, count, mean, m2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.m2 += m2 + np.outer(delta, delta) * (self.count * count / total)
+        self.mean += delta * (count / total)
+        self.count = total
+        return self
+
+    @classmethod
+    def from_batches(cls, batches, dim):
+        """
+        :param batches: Iterable of (num_samples, dim) batches, e.g. streamed from disk.
+        :param dim: Dimension of the feature vectors.
+        :return: The accumulator of all batches.
+        """
+        moments = cls(dim)
+        for batch in batches:
+            moments.update(batch)
+        return moments
+
+    def covariance(self, ddof=1):
+        """
+        :param ddof: Delta degrees of freedom, 1 matches np.cov.
+        :return: The (dim, dim) covariance matrix.
+        """
+        if self.count <= ddof:
+            raise ValueError(f"Need more than {ddof} samples to compute a covariance, got {self.count}.")
+        return self.m2 / (self.count - ddof)
+
+    def variance(self, ddof=1):
+        """
+        :param ddof: Delta degrees of freedom, 0 matches sklearn's StandardScaler.
+        :return: The (dim,) per-feature variance.
+        """
+        return np.diag(self.m2) / (self.count - ddof)
+
+    def standard_scale(self):
+        """
+        :return: The (dim,) per-feature scale of sklearn's StandardScaler, constant features are left unscaled.
+        """
+        scale = np.sqrt(self.variance(ddof=0))
+        scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.0
+        return scale
+
+
+def standardized_cholesky(scatter, num_dof, scale, regularization=1e-6):
+    """
+    Shared fitting step of the Mahalanobis scorers: the covariance of the standardized features, ridge
+    regularized and factored as L L^T.
+    :param scatter: (dim, dim) sum of outer products of the deviations, e.g. OnlineCovariance.m2 or the
+        within-class scatter pooled over classes.
+    :param num_dof: Degrees of freedom the scatter is divided by.
+    :param scale: (dim,) scale the features are standardized with.
+    :param regularization: Added to the diagonal of the standardized covariance.
+    :return: The (dim, dim) lower Cholesky factor.
+    """
+    cov_matrix = scatter / num_dof / np.outer(scale, scale)
+    cov_matrix += np.eye(len(scale)) * regularization
+    return np.linalg.cholesky(cov_matrix)
+
+
+class MahalanobisScorer:
+    """
+    Mahalanobis distance to a fitted feature distribution. Features are standardized as by StandardScaler,
+    and the lower Cholesky factor L of the regularized covariance is kept instead of its inverse, so a whole
+    batch is scored with one triangular solve: d(x) = ||L^-1 ((x - mean) / scale)||.
+    """
+
+    def __init__(self, mean, scale, cholesky):
+        """
+        :param mean: (dim,) mean of the features.
+        :param scale: (dim,) standard deviation used to standardize the features.
+        :param cholesky: (dim, dim) lower Cholesky factor of the covariance of the standardized features.
+        """
+        self.mean = mean
+        self.scale = scale
+        self.cholesky = cholesky
+
+    @classmethod
+    def fit(cls, moments, regularization=1e-6):
+        """
+        :param moments: OnlineCovariance of the in-distribution features.
+        :param regularization: Added to the diagonal of the standardized covariance.
+        :return: The fitted scorer.
+        """
+        if moments.count <= 1:
+            raise ValueError(f"Need more than 1 sample to fit a covariance, got {moments.count}.")
+        scale = moments.standard_scale()
+        cholesky = standardized_cholesky(moments.m2, moments.count - 1, scale, regularization)
+        return cls(moments.mean.copy(), scale, cholesky)
+
+    def whiten(self, features):
+        """
+        :param features: Array (or tensor) of shape (num_samples, dim).
+        :return: (dim, num_samples) whitened samples L^-1 ((x - mean) / scale), NaN columns for non-finite samples.
+        """
+        features = np.asarray(features, dtype=self.mean.dtype).reshape(-1, len(self.mean))
+        num_invalid = np.count_nonzero(~np.isfinite(features).all(axis=1))
+        if num_invalid:
+            print(f"{num_invalid}/{len(features)} samples have NaN or Inf features")
+        diff = (features - self.mean) / self.scale
+        return solve_triangular(self.cholesky, diff.T, lower=True, check_finite=False)
+
+    def score(self, features, squared=False):
+        """
+        :param features: Array (or tensor) of shape (num_samples, dim).
+        :param squared: Return the squared distance, i.e. the quadratic form diff^T cov^-1 diff.
+        :return: (num_samples,) distances, NaN for samples with non-finite features.
+        """
+        whitened = self.whiten(features)
+        squared_distance = np.einsum('ij,ij->j', whitened, whitened)
+        return squared_distance if squared else np.sqrt(squared_distance)
+
+    def _arrays(self):
+        return {'mean': self.mean, 'scale': self.scale, 'cholesky': self.cholesky}
+
+    @classmethod
+    def _from_arrays(cls, data):
+        return cls(data['mean'], data['scale'], data['cholesky'])
+
+    def save(self, path, fingerprint=''):
+        """
+        :param path: .npz file to write the fitted scorer to.
+        :param fingerprint: Identifies the data the scorer was fitted on, checked by load_if_fresh.
+        """
+        np.savez(path, scorer_type=np.array(type(self).__name__), fingerprint=np.array(fingerprint), **self._arrays())
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: .npz file written by save.
+        :return: The fitted scorer.
+        """
+        with np.load(path) as data:
+            scorer_type = str(data['scorer_type']) if 'scorer_type' in data.files else None
+            if scorer_type is not None and scorer_type != cls.__name__:
+                raise ValueError(f"{path} holds a {scorer_type}, not a {cls.__name__}.")
+            scorer = cls._from_arrays(data)
+            scorer.fingerprint = str(data['fingerprint']) if 'fingerprint' in data.files else ''
+        return scorer
+
+    @classmethod
+    def load_if_fresh(cls, path, fingerprint):
+        """
+        :param path: .npz file written by save.
+        :param fingerprint: Fingerprint of the data the scorer should have been fitted on.
+        :return: The saved scorer if it is of this type and was fitted on the same data, None otherwise.
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            scorer = cls.load(path)
+        except (ValueError, KeyError) as e:
+            print(f"Cannot reuse {path}: {e}, refitting.")
+            return None
+        if scorer.fingerprint != fingerprint:
+            print(f"{path} was fitted on other features, refitting.")
+            return None
+        return scorer
+
+
+class ClassConditionalMahalanobisScorer(MahalanobisScorer):
+    """
+    Mahalanobis distance to the closest of K class-conditional Gaussians sharing one (tied) covariance,
+    e.g. one class per in-distribution scenario type. With the whitened samples w_i = L^-1 z_i and class means
+    m_k = L^-1 mu_k, all N x K squared distances are |w_i|^2 + |m_k|^2 - 2 w_i.m_k, i.e. a single matmul.
+    """
+
+    def __init__(self, class_names, mean, scale, class_means, cholesky):
+        """
+        :param class_names: Names of the K classes.
+        :param mean: (dim,) global mean used to standardize the features.
+        :param scale: (dim,) global standard deviation used to standardize the features.
+        :param class_means: (K, dim) class means of the standardized features.
+        :param cholesky: (dim, dim) lower Cholesky factor of the pooled within-class covariance of the
+            standardized features.
+        """
+        super().__init__(mean, scale, cholesky)
+        self.class_names = list(class_names)
+        self.class_means = class_means
+        # Whitened class means are fixed once fitted
+        self.whitened_means = solve_triangular(cholesky, class_means.T, lower=True)
+
+    @classmethod
+    def fit(cls, class_moments, regularization=1e-6):
+        """
+        :param class_moments: Dict {class name: OnlineCovariance of the features of that class}.
+        :param regularization: Added to the diagonal of the standardized pooled covariance.
+        :return: The fitted scorer.
+        """
+        class_moments = {name: moments for name, moments in class_moments.items() if moments.count > 0}
+        if not class_moments:
+            raise ValueError("No class has any sample.")
+        dim = next(iter(class_moments.values())).dim
+        total = OnlineCovariance(dim)
+        for moments in class_moments.values():
+            total.merge(moments)
+        num_dof = total.count - len(class_moments)
+        if num_dof <= 0:
+            raise ValueError(f"Need more samples than classes, got {total.count} samples for {len(class_moments)} classes.")
+
+        scale = total.standard_scale()
+        # Tied covariance: within-class scatter pooled over all classes
+        pooled_m2 = sum(moments.m2 for moments in class_moments.values())
+        cholesky = standardized_cholesky(pooled_m2, num_dof, scale, regularization)
+        class_means = np.stack([(moments.mean - total.mean) / scale for moments in class_moments.values()])
+        return cls(list(class_moments), total.mean.copy(), scale, class_means, cholesky)
+
+    def score_classes(self, features, squared=False):
+        """
+        :param features: Array (or tensor) of shape (num_samples, dim).
+        :param squared: Return squared distances.
+        :return: (num_samples, K) distances of every sample to every class.
+        """
+        whitened = self.whiten(features)
+        squared_distance = (
+            np.einsum('ij,ij->j', whitened, whitened)[:, None]
+            + np.einsum('ij,ij->j', self.whitened_means, self.whitened_means)[None, :]
+            - 2.0 * whitened.T @ self.whitened_means
+        )
+        # The expansion can go slightly negative through cancellation
+        np.maximum(squared_distance, 0.0, out=squared_distance)
+        return squared_distance if squared else np.sqrt(squared_distance)
+
+    def score(self, features, squared=False, return_class=False):
+        """
+        :param features: Array (or tensor) of shape (num_samples, dim).
+        :param squared: Return squared distances.
+        :param return_class: Also return the name of the closest class of every sample.
+        :return: (num_samples,) distances to the closest class, and optionally the closest class names.
+        """
+        distances = self.score_classes(features, squared)
+        if len(distances) == 0:
+            return (distances[:, 0], []) if return_class else distances[:, 0]
+        closest = np.argmin(np.where(np.isnan(distances), np.inf, distances), axis=1)
+        min_distances = distances[np.arange(len(distances)), closest]
+        if return_class:
+            return min_distances, [self.class_names[k] for k in closest]
+        return min_distances
+
+    def _arrays(self):
+        return {**super()._arrays(), 'class_names': np.array(self.class_names), 'class_means': self.class_means}
+
+    @classmethod
+    def _from_arrays(cls, data):
+        return cls(data['class_names'].tolist(), data['mean'], data['scale'], data['class_means'], data['cholesky'])
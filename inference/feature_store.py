@@ -0,0 +1,302 @@
+import hashlib
+import io
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import torch
+
+# The bytes of every array of every scenario are packed into one 1-D uint8 .npy file, the sidecar JSON index
+# maps scenario name -> array name -> (byte offset, shape, dtype) into it.
+INDEX_SUFFIX = '.index.json'
+# Arrays start on this byte boundary, so that their views are aligned whatever the dtype
+ARRAY_ALIGNMENT = 16
+# Name of the array stored for a .pt file holding a single tensor
+PT_ARRAY_NAME = 'features'
+
+
+def _npy_header(num_bytes):
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(
+        header, {'descr': np.lib.format.dtype_to_descr(np.dtype(np.uint8)), 'fortran_order': False, 'shape': (num_bytes,)}
+    )
+    return header.getvalue()
+
+
+def load_tensor(file_path):
+    """
+    Load a .pt feature file on the CPU.
+    :param file_path: Path to a .pt file.
+    :return: The stored tensor (or object).
+    """
+    return torch.load(file_path, map_location='cpu')
+
+
+def load_pt_arrays(file_path):
+    """
+    Load a .pt feature file as a dict of numpy arrays.
+    :param file_path: Path to a .pt file holding a tensor or a dict of tensors.
+    :return: Dict {array name: array}.
+    """
+    features = load_tensor(file_path)
+    if isinstance(features, dict):
+        return {name: feature.detach().numpy() for name, feature in features.items()}
+    return {PT_ARRAY_NAME: features.detach().numpy()}
+
+
+def load_npz_arrays(file_path):
+    """
+    Load a .npz feature file as a dict of numpy arrays.
+    :param file_path: Path to a .npz file.
+    :return: Dict {array name: array}.
+    """
+    with np.load(file_path) as scenario:
+        return {name: scenario[name] for name in scenario.files}
+
+
+FEATURE_LOADERS = {
+    '.pt': load_pt_arrays,
+    '.npz': load_npz_arrays,
+}
+
+
+def _load_feature_file(load_file, file_path):
+    # Runs in the worker, errors are returned so that one bad file does not abort the whole ingestion
+    try:
+        return load_file(file_path), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def read_failure_report(failure_report_path):
+    """
+    :param failure_report_path: Path of a report written by iter_feature_files.
+    :return: Dict {file name: error} of the failed files, empty if there is no report.
+    """
+    if failure_report_path is None or not os.path.exists(failure_report_path):
+        return {}
+    with open(failure_report_path, 'r') as f:
+        return json.load(f)['failures']
+
+
+def iter_feature_files(folder_path, suffix='.npz', load_file=None, num_workers=8, use_processes=False,
+                       failure_report_path=None, skip_failed=False, progress_every=1000):
+    """
+    Load the feature files of a folder concurrently, yielding them in sorted file name order.
+    At most a few files per worker are in flight, so results are streamed rather than accumulated.
+    :param folder_path: Folder with one feature file per scenario, named <scenario name><suffix>.
+    :param suffix: Extension of the files to load.
+    :param load_file: Function loading one file, defaults to FEATURE_LOADERS[suffix]. Must be a module level
+        function when use_processes is set.
+    :param num_workers: Number of threads or processes reading files.
+    :param use_processes: Use a process pool, for loaders that hold the GIL (e.g. unpickling).
+    :param failure_report_path: JSON file the failed files and their errors are written to, None to skip it.
+    :param skip_failed: Do not retry the files listed in the existing failure report.
+    :param progress_every: Print progress every this many files.
+    :return: A generator of (scenario name, loaded features).
+    """
+    load_file = load_file or FEATURE_LOADERS[suffix]
+    file_names = sorted(file_name for file_name in os.listdir(folder_path) if file_name.endswith(suffix))
+    failures = {}
+    if skip_failed:
+        previous_failures = read_failure_report(failure_report_path)
+        failures = {file_name: previous_failures[file_name] for file_name in file_names if file_name in previous_failures}
+        file_names = [file_name for file_name in file_names if file_name not in failures]
+        if failures:
+            print(f"Skipping {len(failures)} previously failed files of {folder_path}")
+
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    executor = executor_class(max_workers=num_workers)
+    remaining = iter(file_names)
+    pending = deque()
+
+    def submit(file_name):
+        return file_name, executor.submit(_load_feature_file, load_file, os.path.join(folder_path, file_name))
+
+    def submit_next():
+        file_name = next(remaining, None)
+        if file_name is not None:
+            pending.append(submit(file_name))
+
+    start_time = time.time()
+    num_done = 0
+    try:
+        for _ in range(4 * num_workers):
+            submit_next()
+        while pending:
+            file_name, future = pending.popleft()
+            try:
+                result, error = future.result()
+            except BrokenProcessPool:
+                # A dying worker (e.g. killed when out of memory) fails every file in flight. Restart the pool
+                # and retry this file alone, so that only the file that kills a worker is reported
+                executor.shutdown()
+                executor = executor_class(max_workers=num_workers)
+                try:
+                    result, error = submit(file_name)[1].result()
+                except BrokenProcessPool as e:
+                    executor.shutdown()
+                    executor = executor_class(max_workers=num_workers)
+                    result, error = None, f"{type(e).__name__}: {e}"
+                in_flight = [name for name, _ in pending]
+                pending.clear()
+                pending.extend(submit(name) for name in in_flight)
+            except Exception as e:
+                # e.g. a result that cannot be sent back from the worker
+                result, error = None, f"{type(e).__name__}: {e}"
+            submit_next()
+            num_done += 1
+            if num_done % progress_every == 0 or num_done == len(file_names):
+                rate = num_done / max(time.time() - start_time, 1e-9)
+                print(f"Loaded {num_done}/{len(file_names)} files from {folder_path} ({rate:.0f} files/s)")
+            if error is not None:
+                failures[file_name] = error
+                print(f"Failed to load {os.path.join(folder_path, file_name)}: {error}")
+                continue
+            yield file_name.split('.')[0], result
+    finally:
+        executor.shutdown()
+        if failure_report_path is not None:
+            with open(failure_report_path, 'w') as f:
+                json.dump({'folder_path': folder_path, 'num_files': num_done, 'failures': failures}, f, indent=2)
+
+
+def build_feature_store(folder_path, store_path, suffix='.npz', dtype=None, **loader_kwargs):
+    """
+    Pack the per-scenario feature files of a folder into a single .npy file and its JSON index.
+    Files are read concurrently but appended in order, so memory use is bounded by the files in flight.
+    :param folder_path: Folder with one feature file per scenario, named <scenario name><suffix>.
+    :param store_path: Path of the .npy file to write, the index is written to <store_path>.index.json.
+    :param suffix: Either '.pt' or '.npz'.
+    :param dtype: dtype floating point arrays are cast to (e.g. np.float32 to halve float64 features),
+        None keeps the dtype of every array. Integer and boolean arrays always keep theirs.
+    :param loader_kwargs: Passed to iter_feature_files, e.g. num_workers or failure_report_path.
+    :return: The number of packed scenarios.
+    """
+    if suffix not in FEATURE_LOADERS:
+        raise ValueError(f"suffix must be one of {list(FEATURE_LOADERS)}, got '{suffix}'.")
+    # The 1-D npy header has a fixed size, so it is reserved up front and written once the length is known
+    header_size = len(_npy_header(0))
+
+    entries = {}
+    offset = 0
+    tmp_path = f'{store_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.seek(header_size)
+        for scenario_name, arrays in iter_feature_files(folder_path, suffix, **loader_kwargs):
+            entry = {}
+            for array_name, array in arrays.items():
+                array = np.asarray(array)
+                if array.dtype.hasobject:
+                    raise ValueError(f"Cannot pack the object array '{array_name}' of scenario {scenario_name}.")
+                if dtype is not None and np.issubdtype(array.dtype, np.floating):
+                    array = array.astype(dtype)
+                array = np.ascontiguousarray(array)
+                padding = -offset % ARRAY_ALIGNMENT
+                f.write(bytes(padding))
+                offset += padding
+                f.write(array.tobytes())
+                entry[array_name] = {'offset': offset, 'shape': list(array.shape), 'dtype': array.dtype.str}
+                offset += array.nbytes
+            entries[scenario_name] = entry
+
+        header = _npy_header(offset)
+        if len(header) != header_size:
+            raise RuntimeError(f"Unexpected npy header size {len(header)}, expected {header_size}.")
+        f.seek(0)
+        f.write(header)
+    os.replace(tmp_path, store_path)
+
+    with open(store_path + INDEX_SUFFIX, 'w') as f:
+        json.dump({'num_bytes': offset, 'scenarios': entries}, f)
+    print(f"Packed {len(entries)} scenarios ({offset} bytes) from {folder_path} into {store_path}")
+    return len(entries)
+
+
+def fingerprint_features(folder_path, store_path=None, suffix='.pt'):
+    """
+    Fingerprint the features a model is fitted on: the packed store when it exists, since it is read instead of
+    the folder, otherwise the name, mtime and size of every feature file of the folder.
+    :param folder_path: Folder with one feature file per scenario.
+    :param store_path: Path of the store built from the folder, if any.
+    :param suffix: Extension of the feature files.
+    :return: A hex digest that changes whenever the features change.
+    """
+    if store_path is not None and os.path.exists(store_path):
+        paths = [store_path, store_path + INDEX_SUFFIX]
+    else:
+        with os.scandir(folder_path) as entries:
+            paths = sorted(entry.path for entry in entries if entry.name.endswith(suffix))
+    digest = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}\0{stat.st_mtime_ns}\0{stat.st_size}\n".encode())
+    return digest.hexdigest()
+
+
+class FeatureStore:
+    """
+    Read-only view of a store written by build_feature_store. The data file is memory mapped, so opening
+    the store is instant and processes reading the same store share the page cache.
+    """
+
+    def __init__(self, store_path, mmap_mode='r'):
+        """
+        :param store_path: Path of the .npy file.
+        :param mmap_mode: 'r' for read-only views, 'c' for copy-on-write views that can be wrapped as tensors.
+        """
+        self.store_path = store_path
+        with open(store_path + INDEX_SUFFIX, 'r') as f:
+            index = json.load(f)
+        self.scenarios = index['scenarios']
+        if 'num_bytes' not in index:
+            raise ValueError(f"{store_path} was packed by an older version, rebuild it with build_feature_store.")
+        self.data = np.load(store_path, mmap_mode=mmap_mode)
+        if self.data.dtype != np.uint8 or len(self.data) != index['num_bytes']:
+            raise ValueError(f"Index of {store_path} does not match its data file.")
+
+    def __len__(self):
+        return len(self.scenarios)
+
+    def __contains__(self, scenario_name):
+        return scenario_name in self.scenarios
+
+    def __iter__(self):
+        return iter(self.scenarios)
+
+    def names(self):
+        return list(self.scenarios)
+
+    def get_array(self, scenario_name, array_name=PT_ARRAY_NAME):
+        """
+        :param scenario_name: Scenario to read.
+        :param array_name: Array of the scenario to read.
+        :return: A view of the array into the memory mapped data, in its stored dtype, no data is copied.
+        """
+        entry = self.scenarios[scenario_name][array_name]
+        dtype = np.dtype(entry['dtype'])
+        num_bytes = int(np.prod(entry['shape'])) * dtype.itemsize
+        return self.data[entry['offset']:entry['offset'] + num_bytes].view(dtype).reshape(entry['shape'])
+
+    def __getitem__(self, scenario_name):
+        """
+        :param scenario_name: Scenario to read.
+        :return: Dict {array name: view}, in the order the arrays had in the source file.
+        """
+        return {array_name: self.get_array(scenario_name, array_name) for array_name in self.scenarios[scenario_name]}
+
+
+def main():
+    plantf_path = os.getenv('PLANTF', '/home/sgwang/planTF')
+    norm_path = os.path.join(plantf_path, 'inference_x')
+    build_feature_store(norm_path, norm_path + '.npy', suffix='.pt', failure_report_path=norm_path + '.failures.json')
+    scenario_path = os.path.join(plantf_path, 'encoder_features')
+    build_feature_store(
+        scenario_path, scenario_path + '.npy', suffix='.npz', failure_report_path=scenario_path + '.failures.json'
+    )
+
+if __name__ == '__main__':
+    main()
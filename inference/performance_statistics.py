@@ -176,3 +176,74 @@ def find_common_scenario_types(plantf_ind, gameformer_ind):
     print(common_df)
     return common_df
 
+
+
+def count_risk_by_experiment(df: pd.DataFrame, risk_label: bool = True, scenario_distribution=None) -> pd.DataFrame:
+    """
+    Count the scenarios of each scenario_type with the given risk_label for every experiment, in one groupby.
+    Generalizes find_common_scenario_types to any number of experiments loaded by ReportProcessor.load_experiments.
+
+    Parameters:
+    - df (pd.DataFrame): Long-format DataFrame with 'experiment', 'scenario_type' and 'risk_label' columns.
+    - risk_label (bool): The risk_label value to count.
+    - scenario_distribution (str): Only count 'InD' or 'OOD' scenarios, all scenarios if None.
+
+    Returns:
+    - pd.DataFrame: Counts indexed by scenario_type with one column per experiment.
+    """
+    if 'experiment' not in df.columns or 'risk_label' not in df.columns:
+        raise ValueError("The DataFrame must contain 'experiment' and 'risk_label' columns.")
+    mask = df['risk_label'] == risk_label
+    if scenario_distribution is not None:
+        mask &= df['scenario_distribution'] == scenario_distribution
+
+    counts = (
+        df[mask]
+        .groupby(['scenario_type', 'experiment'], observed=False)
+        .size()
+        .unstack('experiment', fill_value=0)
+    )
+    counts.columns = list(counts.columns)
+    counts = counts.loc[counts.sum(axis=1) > 0]
+    return counts.sort_values(by=list(counts.columns), ascending=False)
+
+
+def find_common_scenario_types_across_experiments(counts: pd.DataFrame) -> pd.DataFrame:
+    """
+    Keep the scenario types counted in every experiment, as find_common_scenario_types does for two.
+
+    Parameters:
+    - counts (pd.DataFrame): Output of count_risk_by_experiment.
+
+    Returns:
+    - pd.DataFrame: The rows of counts that are non-zero for all experiments.
+    """
+    common_df = counts.loc[(counts > 0).all(axis=1)]
+    print(common_df)
+    return common_df
+
+
+def compare_metrics_by_distribution(df: pd.DataFrame, metrics) -> pd.DataFrame:
+    """
+    Average metrics per experiment and scenario_distribution in one groupby, and the InD - OOD delta.
+
+    Parameters:
+    - df (pd.DataFrame): Long-format DataFrame with 'experiment' and 'scenario_distribution' columns.
+    - metrics (list): Metric columns to compare.
+
+    Returns:
+    - pd.DataFrame: Indexed by experiment, with (metric, 'InD' / 'OOD' / 'delta') columns.
+    """
+    missing_metrics = [metric for metric in metrics if metric not in df.columns]
+    if missing_metrics:
+        raise ValueError(f"The following metrics are missing from the DataFrame: {missing_metrics}")
+
+    means = (
+        df.groupby(['experiment', 'scenario_distribution'], observed=True)[list(metrics)]
+        .mean()
+        .unstack('scenario_distribution')
+        .reindex(columns=pd.MultiIndex.from_product([list(metrics), ['InD', 'OOD']]))
+    )
+    for metric in metrics:
+        means[(metric, 'delta')] = means[(metric, 'InD')] - means[(metric, 'OOD')]
+    return means[pd.MultiIndex.from_product([list(metrics), ['InD', 'OOD', 'delta']])]
@@ -1,10 +1,61 @@
 import os
+import json
+from collections.abc import Mapping
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
 import hydra
 from hydra.utils import instantiate
 from omegaconf import DictConfig, OmegaConf
 
+# Schema metadata entry holding the fingerprint of the sources a merged report was built from
+MERGED_REPORT_KEY = b'merged_report_key'
+CATEGORICAL_COLUMNS = ['scenario_type', 'log_name']
+
 class ReportProcessor:
+    @classmethod
+    def load_experiments(cls, cfg: DictConfig, runner_report_dirs=None, use_cache: bool = True) -> pd.DataFrame:
+        """
+        Load the merged reports of many experiments concurrently into one long-format table.
+        :param cfg: Config shared by all experiments, its runner_report_dir is replaced per experiment.
+        :param runner_report_dirs: Either a mapping {experiment: runner_report_dir} or a list of runner_report_dirs,
+            in which case experiments are named by their path relative to the common parent. Defaults to
+            cfg.runner_report_dirs.
+        :param use_cache: Whether to use the cached merged report of each experiment.
+        :return: The concatenated reports, with a categorical 'experiment' column.
+        """
+        runner_report_dirs = runner_report_dirs if runner_report_dirs is not None else cfg.runner_report_dirs
+        if not isinstance(runner_report_dirs, Mapping):
+            runner_report_dirs = list(runner_report_dirs)
+            if len(runner_report_dirs) == 1:
+                names = [os.path.basename(os.path.normpath(runner_report_dirs[0]))]
+            else:
+                common_dir = os.path.commonpath([os.path.abspath(d) for d in runner_report_dirs])
+                names = [os.path.relpath(os.path.abspath(d), common_dir) for d in runner_report_dirs]
+            runner_report_dirs = dict(zip(names, runner_report_dirs))
+        if not runner_report_dirs:
+            raise ValueError("No runner_report_dirs to load.")
+
+        def load(runner_report_dir):
+            experiment_cfg = cfg.copy()
+            experiment_cfg.runner_report_dir = runner_report_dir
+            return cls(experiment_cfg).load_merged_report(use_cache=use_cache)
+
+        num_workers = cfg.get('num_workers') or 8
+        with ThreadPoolExecutor(max_workers=min(num_workers, len(runner_report_dirs))) as executor:
+            dfs = list(executor.map(load, runner_report_dirs.values()))
+
+        # Categories differ between experiments, so concat falls back to object and they are re-encoded once
+        df = pd.concat(dfs, keys=list(runner_report_dirs), names=['experiment', None])
+        df = df.reset_index(level='experiment').reset_index(drop=True)
+        df['experiment'] = pd.Categorical(df['experiment'], categories=list(runner_report_dirs))
+        for col in CATEGORICAL_COLUMNS:
+            if col in df.columns:
+                df[col] = df[col].astype('category')
+        print(f"Loaded {len(df)} scenarios from {len(runner_report_dirs)} experiments")
+        return df
+
     def __init__(self,cfg:DictConfig):
         """
         Initialize the ReportProcessor class.
@@ -17,6 +68,12 @@ class ReportProcessor:
         self.runner_columns = cfg.runner_columns or ['scenario_type', 'scenario_name', 'log_name', 'risk_score']
         # Default columns for metric_report
         self.metric_columns = cfg.metric_columns or ['scenario_name', 'metric_score']
+        # Number of threads reading metric files
+        self.num_workers = cfg.get('num_workers') or 8
+        # Cached merged report, stored next to the runner_report
+        self.merged_report_path = os.path.join(
+            self.file_path, cfg.get('merged_report_file') or 'merged_report.parquet'
+        )
 
     def read_runner_reports(self) -> pd.DataFrame:
         """
@@ -26,16 +83,43 @@ class ReportProcessor:
         if not os.path.exists(runner_report):
             raise FileNotFoundError(f"File {runner_report} does not exist.")
 
-        # Read the runner_report file and extract the specified columns
-        df = pd.read_parquet(runner_report)
-        if not all(col in df.columns for col in self.runner_columns):
+        # Check the schema first, then only read the specified columns from disk
+        columns = pq.read_schema(runner_report).names
+        if not all(col in columns for col in self.runner_columns):
             raise ValueError(f"One or more specified columns {self.runner_columns} do not exist in runner_report.")
-        df = df[self.runner_columns]
+        df = pd.read_parquet(runner_report, columns=self.runner_columns)
         return df
 
+    def list_metric_files(self) -> list:
+        """
+        List all .parquet files of the metric folder, in os.walk order.
+        """
+        metric_file_path = os.path.join(self.file_path, 'metrics')
+        return [
+            os.path.join(root, file)
+            for root, _, files in os.walk(metric_file_path)
+            for file in files
+            if file.endswith('.parquet')
+        ]
+
+    def read_metric_report(self, metric_file: str) -> pd.DataFrame:
+        """
+        Read the specified columns of one metric .parquet file, indexed by scenario_name.
+        The metric_score column is renamed after the file name (removing .parquet).
+        """
+        file = os.path.basename(metric_file)
+        columns = pq.read_schema(metric_file).names
+        if not all(col in columns for col in self.metric_columns):
+            raise ValueError(f"One or more specified columns {self.metric_columns} do not exist in {file}.")
+        df_metric = pd.read_parquet(metric_file, columns=self.metric_columns)
+        metric_name = file.replace('.parquet', '')
+        df_metric = df_metric.rename(columns={'metric_score': f'{metric_name}'})
+        return df_metric.set_index('scenario_name')
+
     def read_metric_reports(self) -> pd.DataFrame:
         """
         Read all .parquet files from the metric folder and merge them with runner_report on scenario_name.
+        Files are read concurrently and combined with a single keyed concat instead of one merge per file.
         """
         # Read runner_report data
         runner_df = self.read_runner_reports()
@@ -46,21 +130,75 @@ class ReportProcessor:
             raise FileNotFoundError(f"Directory {metric_file_path} does not exist.")
 
         # Traverse all .parquet files in the metric folder
-        for root, _, files in os.walk(metric_file_path):
-            for file in files:
-                if file.endswith('.parquet'):
-                    metric_file = os.path.join(root, file)
-
-                    # Read the current metric_report file and extract columns
-                    df_metric = pd.read_parquet(metric_file)
-                    if not all(col in df_metric.columns for col in self.metric_columns):
-                        raise ValueError(f"One or more specified columns {self.metric_columns} do not exist in {file}.")
-                    df_metric = df_metric[self.metric_columns]
-
-                    # Rename the metric_score column based on the file name (removing .parquet)
-                    metric_name = file.replace('.parquet', '')
-                    df_metric.rename(columns={'metric_score': f'{metric_name}'}, inplace=True)
-
-                    # Merge with runner_df on scenario_name
-                    runner_df = pd.merge(runner_df, df_metric, on='scenario_name', how='left')
-        return runner_df
\ No newline at end of file
+        metric_files = self.list_metric_files()
+        if not metric_files:
+            return runner_df
+
+        # Reading parquet releases the GIL, so threads overlap the I/O and decoding of the files
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            metric_dfs = list(executor.map(self.read_metric_report, metric_files))
+
+        # A keyed concat needs unique scenario names, merge the rare files with duplicates one by one
+        unique_dfs = [df_metric for df_metric in metric_dfs if df_metric.index.is_unique]
+        duplicated_dfs = [df_metric for df_metric in metric_dfs if not df_metric.index.is_unique]
+        if unique_dfs:
+            runner_df = runner_df.join(pd.concat(unique_dfs, axis=1), on='scenario_name')
+        for df_metric in duplicated_dfs:
+            runner_df = pd.merge(runner_df, df_metric.reset_index(), on='scenario_name', how='left')
+        return runner_df
+
+    def source_fingerprint(self) -> str:
+        """
+        Fingerprint the runner_report and metric files (relative path, mtime and size) together with
+        the selected columns, so that any change of the inputs invalidates the merged report.
+        """
+        source_files = [os.path.join(self.file_path, 'runner_report.parquet')] + self.list_metric_files()
+        sources = []
+        for source_file in source_files:
+            stat = os.stat(source_file)
+            sources.append([os.path.relpath(source_file, self.file_path), stat.st_mtime_ns, stat.st_size])
+        return json.dumps({
+            'runner_columns': list(self.runner_columns),
+            'metric_columns': list(self.metric_columns),
+            'sources': sources,
+        }, sort_keys=True)
+
+    def write_merged_report(self, df: pd.DataFrame, fingerprint: str):
+        """
+        Write the merged report as a single parquet file, with the source fingerprint in its schema metadata.
+        The file is written next to its final path and renamed, so readers never see a partial file.
+        """
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[MERGED_REPORT_KEY] = fingerprint.encode()
+        table = table.replace_schema_metadata(metadata)
+        tmp_path = f'{self.merged_report_path}.tmp'
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, self.merged_report_path)
+
+    def load_merged_report(self, use_cache: bool = True) -> pd.DataFrame:
+        """
+        Same result as read_metric_reports, with scenario_type and log_name as categoricals.
+        The merged frame is cached as one parquet file and reused while the runner_report and metric files
+        keep the same mtimes and sizes, otherwise it is rebuilt and the cache rewritten.
+        :param use_cache: Whether to read and write the cached merged report.
+        :return: The merged report.
+        """
+        fingerprint = self.source_fingerprint()
+        if use_cache and os.path.exists(self.merged_report_path):
+            metadata = pq.read_schema(self.merged_report_path).metadata or {}
+            if metadata.get(MERGED_REPORT_KEY) == fingerprint.encode():
+                print(f"Loaded cached merged report {self.merged_report_path}")
+                return pd.read_parquet(self.merged_report_path)
+
+        df = self.read_metric_reports()
+        for col in CATEGORICAL_COLUMNS:
+            if col in df.columns:
+                df[col] = df[col].astype('category')
+        if use_cache:
+            try:
+                self.write_merged_report(df, fingerprint)
+                print(f"Saved merged report to {self.merged_report_path}")
+            except OSError as e:
+                print(f"Could not save merged report to {self.merged_report_path}: {e}")
+        return df
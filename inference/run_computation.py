@@ -2,7 +2,7 @@ import pandas as pd
 import os
 from omegaconf import DictConfig 
 from read_report import ReportProcessor
-from compute_post_scores import ComputePostScore
+from compute_post_scores import ComputePostScore, stream_post_scores
 import hydra
 from hydra.utils import instantiate
 from visualization import DataVisualization
@@ -12,14 +12,39 @@ def run_computation(cfg:DictConfig):
     processor = ReportProcessor(
         cfg
     )
-    result_df = processor.read_metric_reports()
+    result_df = processor.load_merged_report()
     InD_scenarios= load_scenario_types_from_csv('scenario_type_counts.csv')
     labeled_df = label_scenarios(result_df, InD_scenarios) 
     compute_postscore=ComputePostScore(labeled_df, cfg)
-    energy_score = compute_postscore.get_energy_score()
-    average_energy_score = compute_postscore.calculate_average_ood_score()
+    scored_df = compute_postscore.compute_scores(['energy'])
     visualizer = DataVisualization(figsize=(12, 8), alpha=0.6, grid=True)
-    visualizer.draw_distribution(average_energy_score, score='ood_score_avg')
+    visualizer.draw_distribution(scored_df, score='energy_ood_score_avg')
+
+def run_streaming_computation(cfg:DictConfig):
+    # Bounded-memory variant for runner reports that do not fit in memory, scores are written to disk
+    output_path = os.path.join(cfg.runner_report_dir, cfg.scored_report_file)
+    stream_post_scores(cfg, output_path, scores=['energy'], batch_size=cfg.score_batch_size)
+    scored_df = pd.read_parquet(output_path)
+    InD_scenarios= load_scenario_types_from_csv('scenario_type_counts.csv')
+    labeled_df = label_scenarios(scored_df, InD_scenarios)
+    visualizer = DataVisualization(figsize=(12, 8), alpha=0.6, grid=True)
+    visualizer.draw_distribution(labeled_df, score='energy_ood_score_avg')
+
+def run_comparison(cfg:DictConfig):
+    # Load all experiments at once and compare them in a single long-format table
+    result_df = ReportProcessor.load_experiments(cfg)
+    # Compare the configured metrics, or every metric column loaded from the metric reports
+    metrics = cfg.get('comparison_metrics') or [
+        col for col in result_df.columns if col not in set(cfg.runner_columns) | {'experiment'}
+    ]
+    InD_scenarios= load_scenario_types_from_csv('scenario_type_counts.csv')
+    labeled_df = label_scenarios(result_df, InD_scenarios)
+    labeled_df = add_risk_label(labeled_df)
+    risk_counts = count_risk_by_experiment(labeled_df, risk_label=True, scenario_distribution='InD')
+    find_common_scenario_types_across_experiments(risk_counts)
+    metric_deltas = compare_metrics_by_distribution(labeled_df, list(metrics))
+    print(metric_deltas)
+    return risk_counts, metric_deltas
 
 if __name__ == "__main__":
     CONFIG_PATH = 'config'
@@ -27,4 +52,9 @@ if __name__ == "__main__":
     hydra.core.global_hydra.GlobalHydra.instance().clear()
     hydra.initialize(config_path=CONFIG_PATH)
     cfg = hydra.compose(config_name=CONFIG_NAME)
-    run_computation(cfg)
\ No newline at end of file
+    if cfg.runner_report_dirs:
+        run_comparison(cfg)
+    elif cfg.streaming:
+        run_streaming_computation(cfg)
+    else:
+        run_computation(cfg)
\ No newline at end of file
@@ -1,13 +1,20 @@
 import os
+import random
 import pandas as pd
 import yaml
 from collections import defaultdict
 from ruamel.yaml import YAML
 from typing import Any, Dict, List, Optional, Tuple
 from utils.loadyamlconfig import LoadYamlConfig
-from utils.cachecount import CacheCount
+from utils.cachecount import CACHE_LAYOUTS, CacheCount
+from utils.scenario_index import ScenarioTagIndex
 import argparse
 
+PLANNER_CACHE_DIRS = {
+    'planTF': 'exp/InD_train',
+    'Gameformer': 'exp/gameInD/train',
+}
+
 def diff_scenario_types(scenario_filter_types, scenario_type_counts):
     cache_scenario_types = scenario_type_counts.keys()  # 获取 scenario_type_counts 的场景类型
     in_filter_not_in_cache = set(scenario_filter_types) - set(cache_scenario_types)
@@ -35,15 +42,55 @@ def get_resample_scenarios(scenario_type_counts):
     
     return scenario_dict
 
-def generate_scenario_filter_yaml(filtered_scenarios, template_path, output_path):
+def select_resample_tokens(resample_scenarios, db_dir, index_path, cached_tokens=(), seed=0, log_names=None):
+    """
+    Pick the exact scenarios to cache for every deficit from the `scenario_tag` tables of the trainval logs.
+
+    :param resample_scenarios: A dictionary where keys are scenario types and values are the number of missing scenarios.
+    :param db_dir: Directory containing the trainval `.db` logs.
+    :param index_path: Path to the `ScenarioTagIndex` file, refreshed before querying.
+    :param cached_tokens: Scenario tokens that are already in the feature cache and must not be picked again.
+    :param seed: Seed of the random choice among candidate tokens, so that reruns select the same scenarios.
+    :param log_names: Only pick scenarios of these logs, e.g. the train split that the template's `log_names`
+                      keeps, so that no selected token is filtered out downstream. All logs of db_dir if None.
+    :return: A dictionary where keys are scenario types and values are non-empty lists of selected scenario tokens.
+    """
+    cached_tokens = set(cached_tokens)
+    with ScenarioTagIndex(index_path) as index:
+        index.refresh(db_dir)
+        db_files = None if log_names is None else [os.path.join(db_dir, f"{log_name}.db") for log_name in log_names]
+        candidates = index.get_scenario_type_token_map(
+            scenario_types=list(resample_scenarios), db_dir=db_dir, db_files=db_files
+        )
+
+    rng = random.Random(seed)
+    selected_tokens = {}
+    for scenario_type, deficit in resample_scenarios.items():
+        tokens = sorted({token for _, token in candidates.get(scenario_type, [])} - cached_tokens)
+        rng.shuffle(tokens)
+        if len(tokens) < deficit:
+            print(f"Only {len(tokens)} uncached scenarios of type '{scenario_type}' available, {deficit} missing.")
+        if tokens and deficit > 0:
+            selected_tokens[scenario_type] = tokens[:deficit]
+    return selected_tokens
+
+def generate_scenario_filter_yaml(filtered_scenarios, template_path, output_path, scenario_tokens=None):
     """
-    Generates a scenario_filter config YAML file with filtered scenarios written under `scenario_tokens`,
+    Generates a scenario_filter config YAML file with filtered scenarios written under `scenario_types`,
+    and optionally the exact scenarios to include under `scenario_tokens`,
     while preserving the original format, including null fields, indentation, empty lines, and field order.
 
     :param filtered_scenarios: A dictionary where keys are scenario types and values are lists of tokens.
     :param template_path: Path to the template YAML file.
     :param output_path: Path to save the generated YAML file.
+    :param scenario_tokens: Optional list of scenario tokens to write under `scenario_tokens`.
     """
+    # An empty filter means no filtering in nuPlan, caching it would re-cache the whole split
+    if not filtered_scenarios:
+        raise ValueError(f"No scenario types to write to {output_path}, refusing to generate an unfiltered config.")
+    if scenario_tokens is not None and len(scenario_tokens) == 0:
+        raise ValueError(f"No scenario tokens to write to {output_path}, refusing to generate an unfiltered config.")
+
     # Initialize ruamel.yaml
     yaml = YAML()
     yaml.preserve_quotes = True  # Preserve quotes and formatting
@@ -59,6 +106,8 @@ def generate_scenario_filter_yaml(filtered_scenarios, template_path, output_path
 
     # Update the `scenario_types` field in the config
     scenario_filter_config['scenario_types'] = [f'{types}' for types in all_types]
+    if scenario_tokens is not None:
+        scenario_filter_config['scenario_tokens'] = list(scenario_tokens)
 
     # Write the updated YAML back to the output file
     with open(output_path, 'w', encoding='utf-8') as output_file:
@@ -66,25 +115,70 @@ def generate_scenario_filter_yaml(filtered_scenarios, template_path, output_path
 
     print(f"YAML file successfully generated at: {output_path}")
 
+def generate_token_filter_shards(selected_tokens, template_path, output_path, num_shards):
+    """
+    Split the selected scenario tokens into `num_shards` scenario_filter YAML files of (almost) equal size,
+    one per caching worker. Files are named after `output_path` with a shard suffix, e.g. `resample_0.yaml`.
+
+    :param selected_tokens: A dictionary where keys are scenario types and values are lists of scenario tokens.
+    :param template_path: Path to the template YAML file.
+    :param output_path: Path of the YAML file to generate, suffixed with the shard index when num_shards > 1.
+    :param num_shards: Number of YAML files to generate.
+    :return: The paths of the generated YAML files.
+    """
+    typed_tokens = [
+        (scenario_type, token) for scenario_type, tokens in sorted(selected_tokens.items()) for token in tokens
+    ]
+    if not typed_tokens:
+        raise ValueError("No scenario tokens selected, refusing to generate unfiltered scenario_filter configs.")
+    num_shards = max(1, min(num_shards, len(typed_tokens)))
+    root, ext = os.path.splitext(output_path)
+    output_paths = []
+    for shard in range(num_shards):
+        # Contiguous slices keep each scenario type on as few shards as possible
+        start = len(typed_tokens) * shard // num_shards
+        stop = len(typed_tokens) * (shard + 1) // num_shards
+        shard_tokens = typed_tokens[start:stop]
+        shard_path = output_path if num_shards == 1 else f"{root}_{shard}{ext}"
+        shard_types = dict.fromkeys(scenario_type for scenario_type, _ in shard_tokens)
+        generate_scenario_filter_yaml(shard_types, template_path, shard_path, [token for _, token in shard_tokens])
+        output_paths.append(shard_path)
+    return output_paths
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process planner type and generate resample scenarios.")
     parser.add_argument("--planner", type=str, default='planTF',  # Default to 'planTF' if not provided
+                        choices=sorted(CACHE_LAYOUTS),
                         help="Specify the planner type (e.g., planTF or Gameformer)."
     )
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Feature cache to count, defaults to the planner's InD training cache."
+    )
+    parser.add_argument("--db_dir", type=str,
+                        default=os.path.join(os.environ.get("NUPLAN_DATA_ROOT", ""), "nuplan-v1.1/trainval"),
+                        help="Directory of the trainval .db logs to pick missing scenarios from."
+    )
+    parser.add_argument("--index_path", type=str,
+                        default=os.path.join(os.environ.get("NUPLAN_DATA_ROOT", ""), "nuplan-v1.1/scenario_tag_index.sqlite"),
+                        help="Scenario tag index of the logs, created on first use."
+    )
+    parser.add_argument("--splitter_path", type=str, default='nuplan.yaml',
+                        help="Log splitter config, missing scenarios are only picked from its train logs."
+    )
+    parser.add_argument("--num_shards", type=int, default=1,
+                        help="Number of scenario_filter YAML files to split the selected tokens into."
+    )
     args = parser.parse_args()
     
     configloader = LoadYamlConfig('InD.yaml')
     scenario_filter_types = configloader.get_scenario_type()
     # Example usage:
-    # Determine the cache path and method based on the planner
-    if args.planner == "planTF":
-        cache = CacheCount('exp/InD_train')
-        scenario_type_counts = cache.get_scenario_type_counts()
-    elif args.planner == "Gameformer":
-        cache = CacheCount('exp/gameInD/train')
-        scenario_type_counts = cache.extract_and_count_scenario_types()
-    else:
-        raise ValueError(f"Unsupported planner type: {args.planner}")
+    # The planner selects the registered cache layout, every layout goes through the same counting engine.
+    # For planTF, answer from the caching metadata CSVs, else from the manifest next to the cache which
+    # makes repeated runs over an unchanged cache skip the walk
+    cache_dir = args.cache_dir or PLANNER_CACHE_DIRS[args.planner]
+    cache = CacheCount(cache_dir, use_manifest=True, use_metadata=True, layout=args.planner)
+    scenario_type_counts = cache.get_scenario_type_counts()
     miss_cache=diff_scenario_types(scenario_filter_types, scenario_type_counts)
     resample_scenarios = get_resample_scenarios(scenario_type_counts)
     for scenario in miss_cache:
@@ -92,5 +186,13 @@ if __name__ == "__main__":
         
     template_path = 'template.yaml'
     output_path = 'resample.yaml'             # Path to save the generated YAML file
-    # Generate the YAML
-    generate_scenario_filter_yaml(resample_scenarios, template_path, output_path)
\ No newline at end of file
+    # Select the missing scenarios themselves so that caching only processes the deficit
+    selected_tokens = select_resample_tokens(
+        resample_scenarios, args.db_dir, args.index_path, cached_tokens=cache.get_all_scenario_tokens(),
+        log_names=LoadYamlConfig(args.splitter_path).get_train_log(),
+    )
+    # Generate the YAML, one shard per caching worker
+    if selected_tokens:
+        generate_token_filter_shards(selected_tokens, template_path, output_path, args.num_shards)
+    else:
+        print("No uncached scenarios available for any deficit, no scenario_filter generated.")
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The scripts import `utils.*` from the repository root and the inference modules import each other directly
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.join(REPO_ROOT, "inference"))
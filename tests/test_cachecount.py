@@ -0,0 +1,54 @@
+import os
+import time
+
+import pandas as pd
+
+from utils.cachecount import CacheCount, read_cache_metadata
+
+
+def make_cache(cache_dir, layout):
+    """
+    Create `log/scenario_type/token/feature.gz` directories and the caching metadata listing them.
+    :param layout: {log_name: {scenario_type: number of tokens}}.
+    """
+    file_names = []
+    for log_name, types in layout.items():
+        for scenario_type, num_tokens in types.items():
+            for i in range(num_tokens):
+                token_dir = os.path.join(cache_dir, log_name, scenario_type, f"token_{i}")
+                os.makedirs(token_dir)
+                file_name = os.path.join(token_dir, "feature.gz")
+                open(file_name, "w").close()
+                file_names.append(file_name)
+    os.makedirs(os.path.join(cache_dir, "metadata"))
+    pd.DataFrame({"file_name": file_names}).to_csv(
+        os.path.join(cache_dir, "metadata", "cache_metadata_node_0.csv"), index=False
+    )
+
+
+def touch_later(path):
+    # Avoid depending on the filesystem timestamp resolution
+    later = time.time() + 10
+    os.utime(path, (later, later))
+
+
+def test_metadata_matches_scan(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    make_cache(cache_dir, {"L1": {"a": 3, "b": 3}, "L2": {"a": 3, "b": 3}})
+
+    metadata_counts = CacheCount(cache_dir, use_metadata=True).get_scenario_type_counts()
+    scan_counts = CacheCount(cache_dir).get_scenario_type_counts()
+    assert dict(metadata_counts) == dict(scan_counts) == {"a": 6, "b": 6}
+
+
+def test_token_cached_after_metadata_is_stale(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    make_cache(cache_dir, {"L1": {"a": 3, "b": 3}, "L2": {"a": 3, "b": 3}})
+
+    # A new token only changes the mtime of its scenario type directory
+    os.makedirs(os.path.join(cache_dir, "L2", "b", "late_token"))
+    touch_later(os.path.join(cache_dir, "L2", "b"))
+
+    assert read_cache_metadata(cache_dir) is None
+    metadata_counts = CacheCount(cache_dir, use_metadata=True).get_scenario_type_counts()
+    assert dict(metadata_counts) == {"a": 6, "b": 7}
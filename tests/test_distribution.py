@@ -0,0 +1,56 @@
+import os
+
+from ruamel.yaml import YAML
+
+from utils.distribution import balanced_split_scenarios, process_and_generate_yaml_files
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "template.yaml")
+
+
+def read_filters(output_dir):
+    yaml = YAML()
+    filters = {}
+    for file_name in sorted(os.listdir(output_dir)):
+        with open(os.path.join(output_dir, file_name), "r", encoding="utf-8") as f:
+            filters[file_name] = yaml.load(f)
+    return filters
+
+
+def test_split_never_mixes_whole_types_and_token_ranges():
+    scenario_counts = {"a": 600, "b": 700, "c": 20000}
+    scenario_tokens = {"c": [f"c_{i}" for i in range(20000)]}
+
+    groups = balanced_split_scenarios(scenario_counts, list(scenario_counts), 4, scenario_tokens=scenario_tokens)
+
+    assert len(groups) == 4
+    for group in groups:
+        assert len({tokens is None for _, tokens in group}) == 1
+    assigned_tokens = [token for group in groups for _, tokens in group if tokens is not None for token in tokens]
+    assert sorted(assigned_tokens) == sorted(scenario_tokens["c"])
+
+
+def test_partial_scenario_tokens_write_separate_filters(tmp_path):
+    scenario_counts = {"a": 600, "b": 700, "c": 20000}
+    scenario_tokens = {"c": [f"c_{i}" for i in range(20000)]}
+
+    process_and_generate_yaml_files(
+        scenario_counts, TEMPLATE_PATH, str(tmp_path), num_groups=4, balanced=True, scenario_tokens=scenario_tokens
+    )
+
+    filters = read_filters(str(tmp_path))
+    covered_types = set()
+    for scenario_filter in filters.values():
+        covered_types.update(scenario_filter["scenario_types"])
+        if scenario_filter["scenario_tokens"]:
+            # Tokens apply to every type of a filter, so a filter with tokens only holds the split type
+            assert list(scenario_filter["scenario_types"]) == ["c"]
+    assert covered_types == set(scenario_counts)
+
+
+def test_single_group_keeps_whole_types():
+    scenario_counts = {"a": 600, "c": 20000}
+    scenario_tokens = {"c": [f"c_{i}" for i in range(20000)]}
+
+    groups = balanced_split_scenarios(scenario_counts, list(scenario_counts), 1, scenario_tokens=scenario_tokens)
+
+    assert [[scenario_type for scenario_type, _ in group] for group in groups] == [["a"], ["c"]]
@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+
+from feature_store import FeatureStore, build_feature_store, iter_feature_files, load_npz_arrays, read_failure_report
+
+
+def crash_on_bad(file_path):
+    # Simulates a worker killed while loading a file, e.g. by the out-of-memory killer
+    if os.path.basename(file_path).startswith("bad"):
+        os._exit(1)
+    return load_npz_arrays(file_path)
+
+
+def make_npz_folder(folder_path, names):
+    os.makedirs(folder_path)
+    for i, name in enumerate(names):
+        np.savez(os.path.join(folder_path, f"{name}.npz"), a=np.full((2, 3), i, dtype=np.float32))
+
+
+def test_dead_worker_only_fails_its_file(tmp_path):
+    folder_path = str(tmp_path / "features")
+    names = [f"scenario_{i:02d}" for i in range(12)]
+    make_npz_folder(folder_path, names + ["bad_scenario"])
+    report_path = str(tmp_path / "failures.json")
+
+    loaded = dict(iter_feature_files(
+        folder_path, ".npz", crash_on_bad, num_workers=2, use_processes=True, failure_report_path=report_path
+    ))
+
+    assert sorted(loaded) == names
+    assert list(read_failure_report(report_path)) == ["bad_scenario.npz"]
+
+
+def test_store_keeps_the_dtype_of_every_array(tmp_path):
+    folder_path = str(tmp_path / "features")
+    os.makedirs(folder_path)
+    arrays = {
+        "positions": np.linspace(0, 1, 7, dtype=np.float64).reshape(7, 1),
+        "lane_ids": np.array([3, -1, 2 ** 40], dtype=np.int64),
+        "valid": np.array([True, False, True]),
+        "agent_types": np.arange(5, dtype=np.int8),
+    }
+    np.savez(os.path.join(folder_path, "scenario_0.npz"), **arrays)
+    np.savez(os.path.join(folder_path, "scenario_1.npz"), empty=np.zeros((0, 3), dtype=np.float32))
+    store_path = str(tmp_path / "features.npy")
+
+    build_feature_store(folder_path, store_path, suffix=".npz", num_workers=1)
+
+    store = FeatureStore(store_path)
+    for array_name, array in arrays.items():
+        stored = store.get_array("scenario_0", array_name)
+        assert stored.dtype == array.dtype
+        np.testing.assert_array_equal(stored, array)
+    assert store["scenario_1"]["empty"].shape == (0, 3)
+
+
+def test_store_casts_only_floating_arrays(tmp_path):
+    folder_path = str(tmp_path / "features")
+    os.makedirs(folder_path)
+    np.savez(os.path.join(folder_path, "scenario_0.npz"), a=np.ones(3), ids=np.arange(3))
+    store_path = str(tmp_path / "features.npy")
+
+    build_feature_store(folder_path, store_path, suffix=".npz", dtype=np.float32, num_workers=1)
+
+    store = FeatureStore(store_path)
+    assert store.get_array("scenario_0", "a").dtype == np.float32
+    assert store.get_array("scenario_0", "ids").dtype == np.arange(3).dtype
@@ -0,0 +1,55 @@
+import os
+
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+
+from run_computation import run_comparison
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inference", "config",
+                           "runner_report.yaml")
+# Metric files written by a nuPlan closed-loop simulation
+NUPLAN_METRICS = [
+    "no_ego_at_fault_collisions",
+    "drivable_area_compliance",
+    "driving_direction_compliance",
+    "time_to_collision_within_bound",
+    "ego_progress_along_expert_route",
+    "ego_is_making_progress",
+    "ego_is_comfortable",
+    "speed_limit_compliance",
+]
+
+
+def make_experiment(experiment_dir, seed):
+    rng = np.random.default_rng(seed)
+    scenario_names = [f"scenario_{i}" for i in range(40)]
+    os.makedirs(os.path.join(experiment_dir, "metrics"))
+    pd.DataFrame({
+        "scenario_type": [["stationary", "on_pickup_dropoff"][i % 2] for i in range(40)],
+        "scenario_name": scenario_names,
+        "log_name": [f"log_{i % 4}" for i in range(40)],
+        "risk_score": [rng.normal(size=3) for _ in range(40)],
+    }).to_parquet(os.path.join(experiment_dir, "runner_report.parquet"))
+    for metric in NUPLAN_METRICS:
+        pd.DataFrame({
+            "scenario_name": rng.permutation(scenario_names),
+            "metric_score": rng.random(40),
+        }).to_parquet(os.path.join(experiment_dir, "metrics", f"{metric}.parquet"))
+
+
+def test_run_comparison_on_nuplan_metrics(tmp_path, monkeypatch):
+    experiment_dirs = [str(tmp_path / "planTF"), str(tmp_path / "gameformer")]
+    for seed, experiment_dir in enumerate(experiment_dirs):
+        make_experiment(experiment_dir, seed)
+    monkeypatch.chdir(tmp_path)
+    pd.DataFrame({"scenario_type": ["stationary"]}).to_csv("scenario_type_counts.csv", index=False)
+
+    cfg = OmegaConf.load(CONFIG_PATH)
+    cfg.runner_report_dirs = experiment_dirs
+    risk_counts, metric_deltas = run_comparison(cfg)
+
+    assert list(metric_deltas.index) == ["planTF", "gameformer"]
+    assert set(metric_deltas.columns.get_level_values(0)) == set(NUPLAN_METRICS)
+    assert metric_deltas[("ego_progress_along_expert_route", "delta")].notna().all()
+    assert set(risk_counts.columns) <= {"planTF", "gameformer"}
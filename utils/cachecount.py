@@ -1,67 +1,362 @@
+import glob
+import json
 import os
 import pandas as pd
+from abc import ABC, abstractmethod
 import yaml
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from ruamel.yaml import YAML
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+
+class CacheCensus(NamedTuple):
+    log_names: List[str]
+    scenario_type_counts: Dict[str, int]
+    scenario_tokens: List[str]
+
+
+def list_subdirs(path: str) -> List[str]:
+    """
+    List the sub-directories of a directory using the d_type returned by `os.scandir`,
+    so no extra stat call is needed per entry on filesystems that report it.
+    """
+    with os.scandir(path) as entries:
+        return [entry.name for entry in entries if entry.is_dir()]
+
+
+def scan_log_dir(log_path: str) -> Dict[str, List[str]]:
+    """
+    Scan one `log/scenario_type/token` sub-tree of a feature cache.
+    :return: A dictionary mapping scenario types to the tokens cached for them in this log.
+    """
+    return {
+        scenario_type: list_subdirs(os.path.join(log_path, scenario_type))
+        for scenario_type in list_subdirs(log_path)
+    }
+
+
+def scan_token_dir(token_path: str) -> Tuple[int, float]:
+    """
+    :return: The total size in bytes of the feature files of one cached token and the token dir mtime.
+    """
+    size = 0
+    with os.scandir(token_path) as entries:
+        for entry in entries:
+            if entry.is_file():
+                size += entry.stat().st_size
+    return size, os.stat(token_path).st_mtime
+
+
+def scan_type_dir_manifest(type_path: str) -> Dict[str, Any]:
+    """
+    Scan one `scenario_type` directory of a log into its manifest entry.
+    """
+    tokens = {}
+    for token in list_subdirs(type_path):
+        size, mtime = scan_token_dir(os.path.join(type_path, token))
+        tokens[token] = [size, mtime]
+    return {"tokens": tokens}
+
+
+def update_log_manifest(log_path: str, log_mtime: float, previous: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Bring the manifest entry of one log directory up to date. The scenario type list is only re-read if the
+    log directory mtime changed, and the tokens of a type only if the type directory mtime changed.
+    :param log_path: Path of the log directory.
+    :param log_mtime: Current mtime of the log directory.
+    :param previous: Manifest entry of this log from the last run, None if the log is new.
+    :return: The up-to-date manifest entry {"mtime": ..., "types": {scenario_type: {"mtime": ..., "tokens": ...}}}.
+    """
+    if previous is not None and previous["mtime"] == log_mtime:
+        scenario_types = list(previous["types"])
+    else:
+        scenario_types = list_subdirs(log_path)
+    previous_types = previous["types"] if previous is not None else {}
+
+    types = {}
+    for scenario_type in scenario_types:
+        type_path = os.path.join(log_path, scenario_type)
+        try:
+            type_mtime = os.stat(type_path).st_mtime
+        except FileNotFoundError:
+            continue
+        previous_type = previous_types.get(scenario_type)
+        if previous_type is not None and previous_type["mtime"] == type_mtime:
+            types[scenario_type] = previous_type
+        else:
+            types[scenario_type] = {"mtime": type_mtime, **scan_type_dir_manifest(type_path)}
+    return {"mtime": log_mtime, "types": types}
+
+
+def newest_dir_mtime(log_path: str) -> float:
+    """
+    :return: The newest mtime among a log directory and its scenario type directories. Caching a token
+             changes the mtime of its type directory only, so the type directories must be checked too.
+    """
+    mtime = os.stat(log_path).st_mtime
+    with os.scandir(log_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                mtime = max(mtime, entry.stat().st_mtime)
+    return mtime
+
+
+def read_cache_metadata(cache_dir: str, check_stale: bool = True, num_workers: int = 16) -> Optional[pd.DataFrame]:
+    """
+    Read the `metadata/*_metadata_node_*.csv` files written by nuPlan caching (all nodes merged) into a
+    table of cached scenarios. Each `file_name` is `<cache_dir>/<log>/<scenario_type>/<token>/<feature>`.
+    :param cache_dir: Feature cache directory.
+    :param check_stale: Whether to compare the cache root, log and scenario type directory mtimes against the
+                        newest metadata file, so logs, scenario types or tokens cached afterwards are not missed.
+    :param num_workers: Number of threads used to stat the log directories when checking staleness.
+    :return: A DataFrame with `log_name`, `scenario_type` and `token` columns, one row per cached scenario,
+             or None if the metadata is missing or stale.
+    """
+    metadata_files = sorted(glob.glob(os.path.join(cache_dir, "metadata", "*_metadata_node_*.csv")))
+    if not metadata_files:
+        return None
+
+    if check_stale:
+        metadata_mtime = max(os.stat(metadata_file).st_mtime for metadata_file in metadata_files)
+        if os.stat(cache_dir).st_mtime > metadata_mtime:
+            return None
+        log_paths = [os.path.join(cache_dir, log_name) for log_name in list_subdirs(cache_dir)]
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            if any(mtime > metadata_mtime for mtime in executor.map(newest_dir_mtime, log_paths)):
+                return None
+
+    file_names = pd.concat(
+        [pd.read_csv(metadata_file, usecols=["file_name"]) for metadata_file in metadata_files], ignore_index=True
+    )["file_name"]
+    parts = file_names.str.rsplit("/", n=4, expand=True)
+    if parts.shape[1] < 5:
+        return None
+    records = parts[[1, 2, 3]].dropna()
+    records.columns = ["log_name", "scenario_type", "token"]
+    # One row per feature file, a scenario usually has several
+    return records.drop_duplicates(ignore_index=True)
+
+
+RECORD_COLUMNS = ["log_name", "scenario_type", "token"]
+# Registry of feature cache layouts, keyed by planner name
+CACHE_LAYOUTS: Dict[str, "CacheLayout"] = {}
+
+
+def register_cache_layout(name: str):
+    """
+    Class decorator registering a `CacheLayout` under a planner name, e.g. `@register_cache_layout("planTF")`.
+    The layout is instantiated here, so a layout missing `iter_record_batches` fails at registration.
+    """
+    def decorator(layout_cls):
+        CACHE_LAYOUTS[name] = layout_cls()
+        return layout_cls
+    return decorator
+
+
+def get_cache_layout(name: str) -> "CacheLayout":
+    if name not in CACHE_LAYOUTS:
+        raise ValueError(f"Unsupported cache layout: {name}. Available layouts: {sorted(CACHE_LAYOUTS)}")
+    return CACHE_LAYOUTS[name]
+
+
+def records_from_log_entries(
+    log_entries: Iterator[Tuple[str, Dict[str, List[str]]]], batch_size: int
+) -> Iterator[pd.DataFrame]:
+    """
+    Flatten per-log {scenario_type: [tokens]} dictionaries into record batches of about `batch_size` rows.
+    """
+    columns = ([], [], [])
+    for log_name, entries in log_entries:
+        for scenario_type, tokens in entries.items():
+            columns[0].extend([log_name] * len(tokens))
+            columns[1].extend([scenario_type] * len(tokens))
+            columns[2].extend(tokens)
+        if len(columns[2]) >= batch_size:
+            yield pd.DataFrame(dict(zip(RECORD_COLUMNS, columns)))
+            columns = ([], [], [])
+    if columns[2]:
+        yield pd.DataFrame(dict(zip(RECORD_COLUMNS, columns)))
+
+
+def census_from_records(record_batches: Iterator[pd.DataFrame]) -> CacheCensus:
+    """
+    Counting engine shared by all cache layouts: reduces record batches with vectorized value counts.
+    :param record_batches: DataFrames with `log_name`, `scenario_type` and `token` columns.
+    :return: The census of the cache.
+    """
+    log_names = {}
+    scenario_type_counts = pd.Series(dtype="int64")
+    scenario_tokens = []
+    for records in record_batches:
+        log_names.update(dict.fromkeys(records["log_name"].unique()))
+        scenario_type_counts = scenario_type_counts.add(records["scenario_type"].value_counts(), fill_value=0)
+        scenario_tokens.extend(records["token"].tolist())
+
+    return CacheCensus(
+        list(log_names),
+        defaultdict(int, {scenario_type: int(count) for scenario_type, count in scenario_type_counts.items()}),
+        scenario_tokens,
+    )
+
+
+class CacheLayout(ABC):
+    """
+    Parser for the on-disk layout of one planner's feature cache. Subclasses stream the cached scenarios as
+    record batches, the counting itself is done once for all layouts by `census_from_records`.
+    """
+
+    @abstractmethod
+    def iter_record_batches(self, cache: "CacheCount", batch_size: int = 100_000) -> Iterator[pd.DataFrame]:
+        """
+        :param cache: The cache to read, carries the directory and the scan options.
+        :param batch_size: Approximate number of records per batch.
+        :return: A generator of DataFrames with `log_name`, `scenario_type` and `token` columns.
+        """
+
+
+@register_cache_layout("planTF")
+class DirectoryCacheLayout(CacheLayout):
+    """
+    nuPlan feature cache `log/scenario_type/token/<feature files>`, as written by planTF caching. Answered from
+    the caching metadata, the manifest or a threaded scan, depending on the options of the `CacheCount`.
+    """
+
+    def iter_record_batches(self, cache: "CacheCount", batch_size: int = 100_000) -> Iterator[pd.DataFrame]:
+        records = read_cache_metadata(cache.cache_dir, num_workers=cache.num_workers) if cache.use_metadata else None
+        if records is not None:
+            yield records
+            return
+        if cache.use_metadata:
+            print(f"No up-to-date caching metadata in {cache.cache_dir}, scanning the cache instead.")
+
+        if cache.use_manifest:
+            logs = cache.update_manifest()
+            log_entries = (
+                (log_name, {scenario_type: list(entry["tokens"]) for scenario_type, entry in log["types"].items()})
+                for log_name, log in logs.items()
+            )
+            yield from records_from_log_entries(log_entries, batch_size)
+            return
+
+        log_names = list_subdirs(cache.cache_dir)
+        log_paths = [os.path.join(cache.cache_dir, log_name) for log_name in log_names]
+        with ThreadPoolExecutor(max_workers=cache.num_workers) as executor:
+            yield from records_from_log_entries(zip(log_names, executor.map(scan_log_dir, log_paths)), batch_size)
+
+
+@register_cache_layout("Gameformer")
+class NpzFileCacheLayout(CacheLayout):
+    """
+    Flat directory of `<log_name>_<token>_<scenario_type>.npz` files, as written by Gameformer preprocessing.
+    nuPlan log names contain three underscores, so the type starts after the fifth one.
+    """
+
+    def iter_record_batches(self, cache: "CacheCount", batch_size: int = 100_000) -> Iterator[pd.DataFrame]:
+        with os.scandir(cache.cache_dir) as entries:
+            file_names = [entry.name for entry in entries if entry.name.endswith(".npz")]
+
+        for start in range(0, len(file_names), batch_size):
+            parts = pd.Series(file_names[start:start + batch_size]).str.split("_", n=5, expand=True)
+            if parts.shape[1] < 6:
+                continue
+            # Names with fewer than five underscores are not scenario files
+            parts = parts.dropna(subset=[5])
+            yield pd.DataFrame({
+                "log_name": parts[0] + "_" + parts[1] + "_" + parts[2] + "_" + parts[3],
+                "scenario_type": parts[5].str.split(".", n=1).str[0],
+                "token": parts[4],
+            })
+
 
 class CacheCount:
-    def __init__(self, cache_dir):
+    MANIFEST_VERSION = 1
+
+    def __init__(self, cache_dir, num_workers=16, use_manifest=False, manifest_path=None, use_metadata=False,
+                 layout="planTF"):
+        """
+        :param cache_dir: Feature cache directory.
+        :param num_workers: Number of threads used to walk log directories.
+        :param use_manifest: Whether to persist a manifest of the cache and only rescan changed directories.
+        :param manifest_path: Where to keep the manifest, defaults to `<cache_dir>_manifest.json` next to the cache.
+        :param use_metadata: Whether to answer from the nuPlan caching metadata CSVs without walking the cache,
+                             falling back to a scan when they are missing or stale.
+        :param layout: Name of the registered cache layout, see `CACHE_LAYOUTS`.
+        """
         self.cache_dir = cache_dir
+        # Threads, since the walk is bound by directory listing latency rather than CPU
+        self.num_workers = num_workers
+        self.use_manifest = use_manifest
+        self.use_metadata = use_metadata
+        self.manifest_path = manifest_path or f"{os.path.normpath(cache_dir)}_manifest.json"
+        self.layout = get_cache_layout(layout)
+        self._census = None
+
+    def load_manifest(self) -> Dict[str, Any]:
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get("version") != self.MANIFEST_VERSION:
+            return {}
+        return manifest.get("logs", {})
+
+    def save_manifest(self, logs: Dict[str, Any]):
+        # Write to a temporary file first so an interrupted run never leaves a truncated manifest behind
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as manifest_file:
+            json.dump({"version": self.MANIFEST_VERSION, "logs": logs}, manifest_file)
+        os.replace(tmp_path, self.manifest_path)
+
+    def update_manifest(self) -> Dict[str, Any]:
+        """
+        Rescan the directories whose mtime changed since the last manifest and persist the result.
+        :return: The manifest logs {log_name: {"mtime": ..., "types": {scenario_type: {"mtime": ..., "tokens":
+                 {token: [size, mtime]}}}}}.
+        """
+        previous_logs = self.load_manifest()
+        with os.scandir(self.cache_dir) as entries:
+            log_mtimes = {entry.name: entry.stat().st_mtime for entry in entries if entry.is_dir()}
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            futures = {
+                log_name: executor.submit(
+                    update_log_manifest, os.path.join(self.cache_dir, log_name), log_mtime, previous_logs.get(log_name)
+                )
+                for log_name, log_mtime in log_mtimes.items()
+            }
+            logs = {log_name: future.result() for log_name, future in futures.items()}
+
+        if logs != previous_logs:
+            self.save_manifest(logs)
+        return logs
+
+    def iter_record_batches(self, batch_size=100_000) -> Iterator[pd.DataFrame]:
+        """
+        Stream the cached scenarios as (log_name, scenario_type, token) record batches.
+        """
+        return self.layout.iter_record_batches(self, batch_size)
+
+    def census(self, refresh=False) -> CacheCensus:
+        """
+        Read the cache once through its layout and return log names, scenario type counts and
+        scenario tokens together. The result is kept on the instance.
+        """
+        if self._census is None or refresh:
+            self._census = census_from_records(self.iter_record_batches())
+        return self._census
 
     def get_log_names_from_cache(self):
-        log_names = [
-            folder for folder in os.listdir(self.cache_dir)
-            if os.path.isdir(os.path.join(self.cache_dir, folder))
-        ]
-        return log_names
+        if self._census is not None:
+            return self._census.log_names
+        return list_subdirs(self.cache_dir)
 
     def get_all_scenario_tokens(self):
-        scenario_tokens = []
-        for log_name in os.listdir(self.cache_dir):
-            log_name_path = os.path.join(self.cache_dir, log_name)
-            if os.path.isdir(log_name_path):
-                for scenario_type in os.listdir(log_name_path):
-                    scenario_type_path = os.path.join(log_name_path, scenario_type)
-                    if os.path.isdir(scenario_type_path):
-                        for scenario_token in os.listdir(scenario_type_path):
-                            scenario_token_path = os.path.join(scenario_type_path, scenario_token)
-                            if os.path.isdir(scenario_token_path):
-                                scenario_tokens.append(scenario_token)
-        return scenario_tokens
+        return self.census().scenario_tokens
 
     def get_scenario_type_counts(self):
-        scenario_type_counts = defaultdict(int)
-        for log_name in os.listdir(self.cache_dir):
-            log_name_path = os.path.join(self.cache_dir, log_name)
-            if os.path.isdir(log_name_path):
-                for scenario_type in os.listdir(log_name_path):
-                    scenario_type_path = os.path.join(log_name_path, scenario_type)
-                    if os.path.isdir(scenario_type_path):
-                        token_count = len([
-                            token for token in os.listdir(scenario_type_path)
-                            if os.path.isdir(os.path.join(scenario_type_path, token))
-                        ])
-                        scenario_type_counts[scenario_type] += token_count
-        return scenario_type_counts
-    
+        return self.census().scenario_type_counts
+
     def extract_and_count_scenario_types(self):
-        # Dictionary to count occurrences of each scenario_type
-        scenario_counts = defaultdict(int)
-        # Iterate through all files in the directory
-        for file_name in os.listdir(self.cache_dir):
-            # Check if the file ends with .npz
-            if file_name.endswith(".npz"):
-                try:
-                    # Extract scenario_type from the filename
-                    # Split from the right to isolate scenario_type
-                    parts = file_name.split("_", 5)  # Split into two parts from the left
-                    if len(parts) == 6:
-                        scenario_type = parts[5].split(".")[0]  # Take everything before .npz
-                        # Count the scenario_type
-                        scenario_counts[scenario_type] += 1
-                except Exception as e:
-                    print(f"Error processing file '{file_name}': {e}")
-                    continue
-
-        return scenario_counts
\ No newline at end of file
+        # Gameformer caches are flat `.npz` directories, whatever layout this instance was created with
+        return census_from_records(get_cache_layout("Gameformer").iter_record_batches(self)).scenario_type_counts
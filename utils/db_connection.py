@@ -0,0 +1,131 @@
+import os
+import pathlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Generator, List, Optional
+
+# Connections are cached per thread, since sqlite3 connections must not cross threads by default.
+# Bounded so that sweeping thousands of logs does not exhaust file descriptors.
+MAX_CACHED_CONNECTIONS = 64
+MMAP_SIZE = 1 << 30  # bytes
+CACHE_SIZE_KIB = 64 * 1024
+
+_local = threading.local()
+
+
+def _connection_cache() -> "OrderedDict[str, sqlite3.Connection]":
+    # A forked worker inherits the parent's cache, but SQLite handles must not be shared across processes
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = OrderedDict()
+    return _local.connections
+
+
+def get_connection(db_file: str) -> sqlite3.Connection:
+    """
+    Get a cached read-only connection to a nuPlan log.
+    The log is opened as an immutable URI, so SQLite skips locking and change detection; callers that
+    rewrite a log in place must call `close_connection` before reading it again.
+    :param db_file: Path to the SQLite database file.
+    :return: The connection, with rows accessible by column name.
+    """
+    db_path = os.path.abspath(db_file)
+    connections = _connection_cache()
+    connection = connections.get(db_path)
+    if connection is not None:
+        connections.move_to_end(db_path)
+        return connection
+
+    if not os.path.isfile(db_path):
+        # Otherwise sqlite reports a confusing "unable to open database file"
+        raise FileNotFoundError(f"File {db_path} does not exist.")
+    uri = f"{pathlib.Path(db_path).as_uri()}?mode=ro&immutable=1"
+    connection = sqlite3.connect(uri, uri=True)
+    connection.row_factory = sqlite3.Row
+    connection.execute(f"PRAGMA mmap_size = {MMAP_SIZE};")
+    connection.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB};")
+    connection.execute("PRAGMA query_only = 1;")
+
+    connections[db_path] = connection
+    if len(connections) > MAX_CACHED_CONNECTIONS:
+        _, oldest = connections.popitem(last=False)
+        oldest.close()
+    return connection
+
+
+def close_connection(db_file: str):
+    """
+    Close the cached connection of a log, if any.
+    :param db_file: Path to the SQLite database file.
+    """
+    connection = _connection_cache().pop(os.path.abspath(db_file), None)
+    if connection is not None:
+        connection.close()
+
+
+def close_all_connections():
+    """
+    Close every connection cached by the current thread.
+    """
+    connections = _connection_cache()
+    while connections:
+        _, connection = connections.popitem()
+        connection.close()
+
+
+def execute_many(query_text: str, query_parameters: Any, db_file: str) -> Generator[sqlite3.Row, None, None]:
+    """
+    Runs a query with the provided arguments on a specified Sqlite DB file.
+    This query can return any number of rows, which are fetched lazily from the cursor.
+    :param query_text: The query to run.
+    :param query_parameters: The parameters to provide to the query.
+    :param db_file: The DB file on which to run the query.
+    :return: A generator of rows emitted from the query.
+    """
+    cursor = get_connection(db_file).cursor()
+    try:
+        cursor.execute(query_text, query_parameters)
+        for row in cursor:
+            yield row
+    finally:
+        cursor.close()
+
+
+def execute_batches(
+    query_text: str, query_parameters: Any, db_file: str, batch_size: int
+) -> Generator[List[sqlite3.Row], None, None]:
+    """
+    Same as `execute_many`, but yields lists of at most `batch_size` rows.
+    :param query_text: The query to run.
+    :param query_parameters: The parameters to provide to the query.
+    :param db_file: The DB file on which to run the query.
+    :param batch_size: Maximum number of rows per batch.
+    :return: A generator of row batches emitted from the query.
+    """
+    cursor = get_connection(db_file).cursor()
+    try:
+        cursor.execute(query_text, query_parameters)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cursor.close()
+
+
+def execute_one(query_text: str, query_parameters: Any, db_file: str) -> Optional[sqlite3.Row]:
+    """
+    Runs a query with the provided arguments on a specified Sqlite DB file, returning the first row.
+    :param query_text: The query to run.
+    :param query_parameters: The parameters to provide to the query.
+    :param db_file: The DB file on which to run the query.
+    :return: The first row, or None if the query returned nothing.
+    """
+    cursor = get_connection(db_file).cursor()
+    try:
+        cursor.execute(query_text, query_parameters)
+        return cursor.fetchone()
+    finally:
+        cursor.close()
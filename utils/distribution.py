@@ -8,21 +8,9 @@ import pandas as pd
 from typing import Generator, List, Optional, Set, Tuple, Type, Union, Dict
 from ruamel.yaml import YAML
 from math import ceil
-
-def execute_many(query: str, params: Tuple, db_file: str):
-    """
-    Execute a SQL query on a SQLite database and yield the results row by row.
-    :param query: The SQL query string.
-    :param params: Parameters for the query.
-    :param db_file: Path to the SQLite database file.
-    :yield: Rows from the query result.
-    """
-    with sqlite3.connect(db_file) as conn:
-        conn.row_factory = sqlite3.Row  # Enable dictionary-like row access
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        for row in cursor.fetchall():
-            yield row
+import heapq
+from utils.db_connection import execute_many
+from utils.scenario_index import ScenarioTagIndex
 
 def get_db_scenario_info(log_file: str) -> Generator[Tuple[str, int], None, None]:
     """
@@ -60,26 +48,95 @@ def get_lidarpc_tokens_with_scenario_tag_from_db(log_file: str) -> Generator[Tup
     for row in execute_many(query, (), log_file):
         yield (str(row["type"]), row["token"].hex())
 
-def get_scenario_type_token_map(db_files: List[str]) -> Dict[str, List[Tuple[str, str]]]:
+def get_scenario_counts_and_tokens_from_db(
+    log_file: str, join_lidar_pc: bool = False
+) -> Tuple[Dict[str, int], Dict[str, List[str]]]:
     """
-    Get a map from scenario types to lists of all instances for a given scenario type in the database.
+    Get both the scenario type counts and the tagged LidarPc tokens of a log in a single scan of `scenario_tag`.
+    Replaces running `get_db_scenario_info` and `get_lidarpc_tokens_with_scenario_tag_from_db` back to back.
+    :param log_file: The log file to query.
+    :param join_lidar_pc: Whether to only keep tags whose lidar_pc row exists. `scenario_tag.lidar_pc_token`
+                          already holds the token, so the join is only needed to drop dangling tags.
+    :return: A tuple of ({scenario_tag: count}, {scenario_tag: [tokens]}).
+    """
+    if join_lidar_pc:
+        query = """
+        SELECT  st.type,
+                lp.token
+        FROM scenario_tag AS st
+        INNER JOIN lidar_pc AS lp
+            ON lp.token=st.lidar_pc_token;
+        """
+    else:
+        query = """
+        SELECT  type,
+                lidar_pc_token AS token
+        FROM scenario_tag;
+        """
+
+    scenario_tokens = defaultdict(list)
+    for row in execute_many(query, (), log_file):
+        scenario_tokens[str(row["type"])].append(row["token"].hex())
+
+    scenario_counts = {scenario_type: len(tokens) for scenario_type, tokens in scenario_tokens.items()}
+    return scenario_counts, dict(scenario_tokens)
+
+def aggregate_scenario_counts_and_tokens(
+    db_files: List[str], join_lidar_pc: bool = False
+) -> Tuple[Dict[str, int], Dict[str, List[Tuple[str, str]]]]:
+    """
+    Aggregate scenario counts and the scenario type token map across db files, reading every log once.
     :param db_files: db files to search for available scenario types.
-    :return: dictionary mapping scenario type to list of db/token pairs of that type.
+    :param join_lidar_pc: Whether to only keep tags whose lidar_pc row exists.
+    :return: A tuple of ({scenario_type: total count}, {scenario_type: [(db_file, token)]}).
     """
+    scenario_counts = defaultdict(int)
     available_scenario_types = defaultdict(list)
     for db_file in db_files:
-        for tag, token in get_lidarpc_tokens_with_scenario_tag_from_db(db_file):
-            available_scenario_types[tag].append((db_file, token))
+        db_counts, db_tokens = get_scenario_counts_and_tokens_from_db(db_file, join_lidar_pc)
+        for tag, count in db_counts.items():
+            scenario_counts[tag] += count
+        for tag, tokens in db_tokens.items():
+            available_scenario_types[tag].extend((db_file, token) for token in tokens)
+
+    return scenario_counts, available_scenario_types
 
+def get_scenario_type_token_map(
+    db_files: List[str], index_path: Optional[str] = None
+) -> Dict[str, List[Tuple[str, str]]]:
+    """
+    Get a map from scenario types to lists of all instances for a given scenario type in the database.
+    :param db_files: db files to search for available scenario types.
+    :param index_path: Optional path to a `ScenarioTagIndex` file to answer the query from.
+    :return: dictionary mapping scenario type to list of db/token pairs of that type.
+    """
+    if index_path is not None:
+        with ScenarioTagIndex(index_path) as index:
+            index.update(db_files)
+            db_paths = {os.path.abspath(db_file): db_file for db_file in db_files}
+            available_scenario_types = defaultdict(list)
+            for tag, pairs in index.get_scenario_type_token_map(db_files=db_paths).items():
+                available_scenario_types[tag] = [(db_paths[db_path], token) for db_path, token in pairs]
+            return available_scenario_types
+
+    _, available_scenario_types = aggregate_scenario_counts_and_tokens(db_files, join_lidar_pc=True)
     return available_scenario_types
 
 
-def aggregate_scenario_counts(db_dir: str) -> Dict[str, int]:
+def aggregate_scenario_counts(db_dir: str, index_path: Optional[str] = None) -> Dict[str, int]:
     """
     Aggregate scenario counts across multiple SQLite database files.
     :param db_dir: Directory containing multiple `.db` files.
+    :param index_path: Optional path to a `ScenarioTagIndex` file. When given, only logs that were added,
+                       changed or removed since the last call are re-read, and the counts are summed from
+                       the stored per-log contributions.
     :return: A dictionary with scenario types as keys and their total counts as values.
     """
+    if index_path is not None:
+        with ScenarioTagIndex(index_path) as index:
+            index.refresh(db_dir)
+            return defaultdict(int, index.get_scenario_counts(db_dir))
+
     scenario_counts = defaultdict(int)
 
     # Iterate over all `.db` files in the directory
@@ -206,7 +263,93 @@ def evenly_split_scenarios(scenarios: List[str], num_groups: int) -> List[List[s
     group_size = ceil(len(scenarios) / num_groups)
     return [scenarios[i:i + group_size] for i in range(0, len(scenarios), group_size)]
 
-def generate_scenario_filter_yaml(filtered_scenarios: List[str], template_path: str, output_path: str):
+def _lpt_groups(items: List[Tuple[int, str, Optional[List[str]]]], num_groups: int):
+    """
+    Greedily assign the heaviest remaining item to the lightest group (LPT bin packing).
+
+    :param items: (weight, scenario_type, tokens) items.
+    :param num_groups: The number of groups to split into.
+    :return: The groups, each a list of (scenario_type, tokens) items, and their loads.
+    """
+    groups = [[] for _ in range(num_groups)]
+    loads = [(0, idx) for idx in range(num_groups)]
+    heapq.heapify(loads)
+    for item_weight, scenario_type, tokens in sorted(items, key=lambda item: (-item[0], item[1])):
+        load, idx = heapq.heappop(loads)
+        groups[idx].append((scenario_type, tokens))
+        heapq.heappush(loads, (load + item_weight, idx))
+    group_loads = [load for load, _ in sorted(loads, key=lambda entry: entry[1])]
+    return groups, group_loads
+
+def balanced_split_scenarios(
+    scenario_counts: Dict[str, int],
+    scenarios: List[str],
+    num_groups: int,
+    num_scenarios_per_type: Optional[int] = None,
+    scenario_tokens: Optional[Dict[str, List[str]]] = None,
+) -> List[List[Tuple[str, Optional[List[str]]]]]:
+    """
+    Split scenario types into groups of (almost) equal work rather than equal number of types,
+    by greedily assigning the heaviest remaining item to the lightest group (LPT bin packing).
+    The work of a type is its count, capped by `num_scenarios_per_type` when given. A type with tokens that is
+    heavier than the ideal group load is further cut into token ranges.
+    A scenario_filter applies its `scenario_tokens` to all of its types, so whole types and token ranges are
+    never put in the same group: the groups are shared between the two in proportion to their work.
+
+    :param scenario_counts: A dictionary with scenario types as keys and their total counts as values.
+    :param scenarios: The scenario types to split.
+    :param num_groups: The number of groups to split into.
+    :param num_scenarios_per_type: Optional per-type cap applied by the scenario filter.
+    :param scenario_tokens: Optional scenario tokens per type, enables splitting a type across groups.
+                            Types without tokens are assigned whole.
+    :return: A list of non-empty groups (fewer than `num_groups` if there are fewer items, two if
+             `num_groups` is 1 but both whole types and token ranges exist), each a list of
+             (scenario_type, tokens) items; tokens is None for whole types.
+    """
+    def weight(scenario_type: str) -> int:
+        count = scenario_counts.get(scenario_type, 0)
+        return count if num_scenarios_per_type is None else min(count, num_scenarios_per_type)
+
+    whole_items, token_items = [], []
+    target_load = max(1, ceil(sum(weight(scenario_type) for scenario_type in scenarios) / num_groups))
+    for scenario_type in scenarios:
+        tokens = scenario_tokens.get(scenario_type) if scenario_tokens is not None else None
+        if not tokens:
+            whole_items.append((weight(scenario_type), scenario_type, None))
+            continue
+        tokens = tokens[:weight(scenario_type)]
+        # Token ranges of at most the ideal group load, so no single item dominates a group
+        for start in range(0, len(tokens), target_load):
+            chunk = tokens[start:start + target_load]
+            token_items.append((len(chunk), scenario_type, chunk))
+
+    num_token_groups = 0
+    if token_items:
+        token_work = sum(item[0] for item in token_items)
+        total_work = token_work + sum(item[0] for item in whole_items)
+        num_token_groups = max(1, round(num_groups * token_work / max(total_work, 1)))
+        if whole_items:
+            num_token_groups = min(num_token_groups, max(1, num_groups - 1))
+    num_whole_groups = max(1, num_groups - num_token_groups) if whole_items else 0
+
+    groups, loads = [], []
+    for items, kind_groups in ((whole_items, num_whole_groups), (token_items, num_token_groups)):
+        if kind_groups:
+            kind_split, kind_loads = _lpt_groups(items, kind_groups)
+            groups += kind_split
+            loads += kind_loads
+
+    for idx, (group, load) in enumerate(zip(groups, loads)):
+        print(f"Group {idx + 1}: {len(group)} items, estimated work {load}")
+    # An empty group would become a scenario_filter without types, i.e. an unfiltered config
+    return [group for group in groups if group]
+
+def generate_scenario_filter_yaml(
+    filtered_scenarios: List[str],
+    template_path: str,
+    output_path: str,
+    scenario_tokens: Optional[List[str]] = None,
+):
     """
     Generates a scenario_filter config YAML file with filtered scenarios written under `scenario_types`,
     while preserving the original format, including null fields, indentation, empty lines, and field order.
@@ -214,6 +357,7 @@ def generate_scenario_filter_yaml(filtered_scenarios: List[str], template_path:
     :param filtered_scenarios: A list of scenario types (tokens) to include in the YAML file.
     :param template_path: Path to the template YAML file.
     :param output_path: Path to save the generated YAML file.
+    :param scenario_tokens: Optional list of scenario tokens to write under `scenario_tokens`.
     """
     # Initialize ruamel.yaml
     yaml = YAML()
@@ -225,6 +369,8 @@ def generate_scenario_filter_yaml(filtered_scenarios: List[str], template_path:
 
     # Update the `scenario_types` field in the config
     scenario_filter_config['scenario_types'] = filtered_scenarios
+    if scenario_tokens is not None:
+        scenario_filter_config['scenario_tokens'] = scenario_tokens
 
     # Write the updated YAML back to the output file
     with open(output_path, 'w', encoding='utf-8') as output_file:
@@ -235,15 +381,23 @@ def generate_scenario_filter_yaml(filtered_scenarios: List[str], template_path:
 def process_and_generate_yaml_files(
     scenario_counts: Dict[str, int],
     template_path: str,
-    output_dir: str
+    output_dir: str,
+    num_groups: int = 4,
+    balanced: bool = False,
+    num_scenarios_per_type: Optional[int] = None,
+    scenario_tokens: Optional[Dict[str, List[str]]] = None,
 ):
     """
     Categorize scenarios into groups, generate YAML files for Group A,
-    and split the combined groups (B, C, D, E) into four evenly distributed YAML files.
+    and split the combined groups (B, C, D, E) into `num_groups` YAML files.
 
     :param scenario_counts: A dictionary with scenario types as keys and their total counts as values.
     :param template_path: Path to the template YAML file.
     :param output_dir: Directory to save the generated YAML files.
+    :param num_groups: Number of YAML files for groups B-E.
+    :param balanced: Split by estimated work with `balanced_split_scenarios` instead of by number of types.
+    :param num_scenarios_per_type: Per-type cap of the scenario filter, used to estimate work when balanced.
+    :param scenario_tokens: Optional tokens of every type, lets a balanced split cut huge types into token ranges.
     """
     # Categorize scenarios
     categorized_scenarios = categorize_scenarios_by_count(scenario_counts)
@@ -263,22 +417,39 @@ def process_and_generate_yaml_files(
         categorized_scenarios["E"]
     )
 
-    # 3. Evenly split the combined scenarios into 4 groups
-    scenario_groups = evenly_split_scenarios(combined_scenarios, 4)
-
-    # 4. Generate YAML files for each of the 4 groups
-    for idx, group in enumerate(scenario_groups):
+    # 3. Split the combined scenarios into groups
+    if balanced:
+        balanced_groups = balanced_split_scenarios(
+            scenario_counts, combined_scenarios, num_groups, num_scenarios_per_type, scenario_tokens
+        )
+    else:
+        balanced_groups = [
+            [(scenario_type, None) for scenario_type in group]
+            for group in evenly_split_scenarios(combined_scenarios, num_groups)
+        ]
+
+    # 4. Generate YAML files for each group
+    for idx, group in enumerate(balanced_groups):
         if group:  # Only generate if the group is not empty
             output_path = os.path.join(output_dir, f"scenario_filter_group_{idx + 1}.yaml")
-            generate_scenario_filter_yaml(group, template_path, output_path)
-            print(f"Generated YAML for Group {idx + 1} with {len(group)} scenarios.")
+            group_types = list(dict.fromkeys(scenario_type for scenario_type, _ in group))
+            # Groups hold either whole types or token ranges, never both
+            group_tokens = [token for _, tokens in group if tokens is not None for token in tokens]
+            generate_scenario_filter_yaml(group_types, template_path, output_path, group_tokens or None)
+            print(f"Generated YAML for Group {idx + 1} with {len(group_types)} scenarios.")
 
 if __name__ == "__main__":
     # Use NUPLAN_DATA_ROOT environment variable
     # db_directory = os.path.join(os.environ["NUPLAN_DATA_ROOT"], "nuplan-v1.1/trainval")
     db_directory = os.path.join(os.environ["NUPLAN_DATA_ROOT"], "nuplan-v1.1/test")
-    # Aggregate scenario counts across all `.db` files
-    total_scenario_counts = aggregate_scenario_counts(db_directory)
+    # Aggregate scenario counts and tokens across all `.db` files, in one scan of every log
+    db_files = sorted(
+        os.path.join(db_directory, db_file) for db_file in os.listdir(db_directory) if db_file.endswith(".db")
+    )
+    total_scenario_counts, scenario_type_token_map = aggregate_scenario_counts_and_tokens(db_files)
+    scenario_tokens = {
+        scenario_type: [token for _, token in pairs] for scenario_type, pairs in scenario_type_token_map.items()
+    }
 
     # Print results
     print("\nAggregated Scenario Counts:")
@@ -291,4 +462,9 @@ if __name__ == "__main__":
     save_to_yaml(total_scenario_counts, output_yaml_path)
     template_path = "/home/sgwang/nuplan/template.yaml"
     output_dir = "/home/sgwang/nuplan/scenario_filter"
-    process_and_generate_yaml_files(total_scenario_counts, template_path, output_dir)
\ No newline at end of file
+    # Balance the shards by scenario count capped at num_scenarios_per_type of the template,
+    # cutting the types heavier than a shard into token ranges
+    process_and_generate_yaml_files(
+        total_scenario_counts, template_path, output_dir, balanced=True, num_scenarios_per_type=1000,
+        scenario_tokens=scenario_tokens,
+    )
\ No newline at end of file
@@ -29,12 +29,9 @@ def count_scenario_types(
     if column_name not in df.columns:
         raise ValueError(f"Column '{column_name}' not found in the CSV file.")
 
-    # Extract scenario_type
-    try:
-        df["scenario_type"] = df[column_name].apply(
-            lambda x: x.split(delimiter)[scenario_type_index]
-        )
-    except IndexError:
+    # Extract scenario_type, out of range indices come back as NaN from the vectorized split
+    df["scenario_type"] = df[column_name].str.split(delimiter).str[scenario_type_index]
+    if df["scenario_type"].isna().any():
         raise IndexError(
             f"The index {scenario_type_index} is out of range. Please check the file path structure and index value."
         )
@@ -4,24 +4,15 @@ from collections import defaultdict
 import matplotlib.pyplot as plt
 import seaborn as sns
 import yaml
-from typing import Generator, Tuple, Dict
+from typing import Generator, Tuple, Dict, List, Optional
 import pandas as pd
+import errno
+import heapq
 import shutil
-
-def execute_many(query: str, params: Tuple, db_file: str):
-    """
-    Execute a SQL query on a SQLite database and yield the results row by row.
-    :param query: The SQL query string.
-    :param params: Parameters for the query.
-    :param db_file: Path to the SQLite database file.
-    :yield: Rows from the query result.
-    """
-    with sqlite3.connect(db_file) as conn:
-        conn.row_factory = sqlite3.Row  # Enable dictionary-like row access
-        cursor = conn.cursor()
-        cursor.execute(query, params)
-        for row in cursor.fetchall():
-            yield row
+from dataclasses import dataclass, field
+from datetime import datetime
+from utils.db_connection import execute_many
+from utils.scenario_index import ScenarioTagIndex
 
 def get_db_scenario_info(log_file: str) -> Generator[Tuple[str, int], None, None]:
     """
@@ -40,12 +31,20 @@ def get_db_scenario_info(log_file: str) -> Generator[Tuple[str, int], None, None
     for row in execute_many(query, (), log_file):
         yield (row["type"], row["cnt"])
 
-def aggregate_scenario_counts(db_dir: str) -> Dict[str, int]:
+def aggregate_scenario_counts(db_dir: str, index_path: Optional[str] = None) -> Dict[str, int]:
     """
     Aggregate scenario counts across multiple SQLite database files.
     :param db_dir: Directory containing multiple `.db` files.
+    :param index_path: Optional path to a `ScenarioTagIndex` file. When given, only logs that were added,
+                       changed or removed since the last call are re-read, and the counts are summed from
+                       the stored per-log contributions.
     :return: A dictionary with scenario types as keys and their total counts as values.
     """
+    if index_path is not None:
+        with ScenarioTagIndex(index_path) as index:
+            index.refresh(db_dir)
+            return defaultdict(int, index.get_scenario_counts(db_dir))
+
     scenario_counts = defaultdict(int)
 
     # Iterate over all `.db` files in the directory
@@ -107,50 +106,253 @@ def aggregate_scenario_counts(db_dir: str) -> Dict[str, int]:
 
 #     print(f"Total unique scenario types moved: {len(moved_scenario_types)}")
 
-def move_scenarios(db_dir: str, target_dir: str, scenario_types: Dict[str, int], max_per_type: int = 500):
+def get_log_scenario_counts(db_dir: str, index_path: Optional[str] = None) -> Dict[str, Dict[str, int]]:
     """
-    Move database files containing specific scenario types to a target directory, 
-    stopping when scenario_type reaches its move limit (500 - count).
+    Get the number of scenarios per scenario type for every `.db` file of a directory.
     :param db_dir: Directory containing `.db` files.
-    :param target_dir: Directory where matching `.db` files will be moved.
+    :param index_path: Optional path to a `ScenarioTagIndex` file to answer the query from.
+    :return: A nested dictionary {db_file: {scenario_type: count}}.
+    """
+    if index_path is not None:
+        with ScenarioTagIndex(index_path) as index:
+            index.refresh(db_dir)
+            return index.get_log_scenario_counts(db_dir)
+
+    log_counts = {}
+    for db_file in sorted(os.listdir(db_dir)):
+        if db_file.endswith(".db"):
+            log_counts[db_file] = dict(get_db_scenario_info(os.path.join(db_dir, db_file)))
+    return log_counts
+
+@dataclass
+class ResamplePlan:
+    """
+    Logs selected to cover the per-type scenario deficits, computed before any file is touched.
+    """
+    deficits: Dict[str, int]
+    selected_logs: List[str] = field(default_factory=list)
+    gains: Dict[str, int] = field(default_factory=dict)
+    total_bytes: int = 0
+
+    @property
+    def remaining(self) -> Dict[str, int]:
+        """
+        Deficits the selected logs could not cover.
+        """
+        return {
+            scenario_type: deficit - self.gains.get(scenario_type, 0)
+            for scenario_type, deficit in self.deficits.items()
+            if self.gains.get(scenario_type, 0) < deficit
+        }
+
+    def print_summary(self):
+        print(f"Resample plan: {len(self.selected_logs)} logs, {self.total_bytes / 1e9:.2f} GB")
+        for scenario_type, deficit in sorted(self.deficits.items()):
+            print(f"  {scenario_type}: {self.gains.get(scenario_type, 0)}/{deficit}")
+        if self.remaining:
+            print(f"Uncovered deficits: {self.remaining}")
+
+def plan_resample(
+    log_counts: Dict[str, Dict[str, int]],
+    deficits: Dict[str, int],
+    log_sizes: Optional[Dict[str, int]] = None,
+) -> ResamplePlan:
+    """
+    Pick a small set of logs whose scenarios cover every deficit, as a greedy weighted set multicover:
+    repeatedly take the log with the most still-needed scenarios per byte, then drop logs that became redundant.
+    :param log_counts: A nested dictionary {db_file: {scenario_type: count}}.
+    :param deficits: Number of scenarios still needed per scenario type.
+    :param log_sizes: Optional size in bytes of every db file, all logs cost the same if None.
+    :return: The plan.
+    """
+    deficits = {scenario_type: deficit for scenario_type, deficit in deficits.items() if deficit > 0}
+    log_sizes = log_sizes or {}
+    remaining = dict(deficits)
+
+    def cost(db_file: str) -> float:
+        return max(log_sizes.get(db_file, 1), 1)
+
+    def coverage(db_file: str) -> int:
+        return sum(min(count, remaining.get(scenario_type, 0)) for scenario_type, count in log_counts[db_file].items())
+
+    # Lazy greedy: a log's coverage only shrinks as deficits get filled, so a stale heap entry is an upper bound
+    heap = [(-coverage(db_file) / cost(db_file), db_file) for db_file in log_counts]
+    heap = [entry for entry in heap if entry[0] < 0]
+    heapq.heapify(heap)
+    selected = []
+    while heap and any(remaining.values()):
+        _, db_file = heapq.heappop(heap)
+        score = coverage(db_file) / cost(db_file)
+        if score <= 0:
+            continue
+        if heap and score < -heap[0][0]:
+            heapq.heappush(heap, (-score, db_file))
+            continue
+        selected.append(db_file)
+        for scenario_type, count in log_counts[db_file].items():
+            if scenario_type in remaining:
+                remaining[scenario_type] = max(remaining[scenario_type] - count, 0)
+
+    gains = defaultdict(int)
+    for db_file in selected:
+        for scenario_type, count in log_counts[db_file].items():
+            if scenario_type in deficits:
+                gains[scenario_type] += count
+
+    # Greedy picks early logs that later ones can make redundant, drop the most expensive of those first
+    for db_file in sorted(selected, key=lambda db_file: (-cost(db_file), db_file)):
+        contributions = {
+            scenario_type: count for scenario_type, count in log_counts[db_file].items() if scenario_type in deficits
+        }
+        if all(gains[scenario_type] - count >= deficits[scenario_type] for scenario_type, count in contributions.items()):
+            selected.remove(db_file)
+            for scenario_type, count in contributions.items():
+                gains[scenario_type] -= count
+
+    return ResamplePlan(
+        deficits=deficits,
+        selected_logs=selected,
+        gains={scenario_type: gains[scenario_type] for scenario_type in deficits},
+        total_bytes=sum(log_sizes.get(db_file, 0) for db_file in selected),
+    )
+
+def _link_db_file(src_path: str, dst_path: str, link_type: str):
+    if link_type == "hardlink":
+        try:
+            os.link(src_path, dst_path)
+            return
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Hardlinks cannot cross filesystems, a symlink still avoids copying the log
+            print(f"Cannot hardlink {src_path} across filesystems, symlinking instead.")
+    os.symlink(os.path.abspath(src_path), dst_path)
+
+def _list_view_versions(view_dir: str) -> List[str]:
+    # Resolved like the target of the view symlink, in case a parent of view_dir is itself a symlink
+    versions_dir = os.path.realpath(f"{view_dir}.versions")
+    if not os.path.isdir(versions_dir):
+        return []
+    return sorted(
+        os.path.join(versions_dir, version) for version in os.listdir(versions_dir) if not version.endswith(".tmp")
+    )
+
+def _point_view_to(view_dir: str, version_path: str):
+    # Replacing a symlink with os.replace is atomic, readers see either the old or the new view
+    tmp_link = f"{view_dir}.link.tmp"
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    # The link target is resolved from the real directory holding the link
+    os.symlink(os.path.relpath(os.path.realpath(version_path), os.path.realpath(os.path.dirname(view_dir))), tmp_link)
+    os.replace(tmp_link, view_dir)
+
+def build_resample_view(
+    plan: ResamplePlan, db_dir: str, view_dir: str, link_type: str = "hardlink", keep_versions: int = 3
+) -> str:
+    """
+    Expose the logs of a plan under `view_dir` without moving or copying them. The links are built in a new
+    version directory under `<view_dir>.versions`, and `view_dir` is a symlink that is swapped atomically to
+    the new version once it is complete, so a failed build leaves the previous view untouched.
+    :param plan: The resample plan to materialize.
+    :param db_dir: Directory containing the planned `.db` files, which stays unchanged.
+    :param view_dir: Path of the view, e.g. `nuplan-v1.1/resample`.
+    :param link_type: `hardlink` (falls back to a symlink across filesystems) or `symlink`.
+    :param keep_versions: Number of view versions kept for `rollback_resample_view`.
+    :return: The path of the new version directory.
+    """
+    if link_type not in ("hardlink", "symlink"):
+        raise ValueError(f"Unsupported link type: {link_type}")
+    if keep_versions < 1:
+        raise ValueError(f"keep_versions must be at least 1 to keep the current view, got {keep_versions}")
+    view_dir = os.path.abspath(view_dir)
+    if os.path.exists(view_dir) and not os.path.islink(view_dir):
+        raise ValueError(f"{view_dir} is a regular directory, move its logs back or choose another view path.")
+
+    version_path = os.path.join(f"{view_dir}.versions", datetime.now().strftime("%Y%m%d-%H%M%S-%f"))
+    tmp_path = f"{version_path}.tmp"
+    os.makedirs(tmp_path)
+    try:
+        for db_file in plan.selected_logs:
+            _link_db_file(os.path.join(db_dir, db_file), os.path.join(tmp_path, db_file), link_type)
+        os.rename(tmp_path, version_path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    _point_view_to(view_dir, version_path)
+    print(f"View {view_dir} now holds {len(plan.selected_logs)} logs ({link_type}s to {db_dir})")
+
+    versions = _list_view_versions(view_dir)
+    for old_version in versions[:max(len(versions) - keep_versions, 0)]:
+        shutil.rmtree(old_version)
+    return version_path
+
+def rollback_resample_view(view_dir: str) -> str:
+    """
+    Point a view built by `build_resample_view` back to its previous version.
+    :param view_dir: Path of the view.
+    :return: The path of the version the view now points to.
+    """
+    view_dir = os.path.abspath(view_dir)
+    current = os.path.realpath(view_dir)
+    versions = _list_view_versions(view_dir)
+    if current not in versions or versions.index(current) == 0:
+        raise ValueError(f"No previous version of {view_dir} to roll back to.")
+    previous = versions[versions.index(current) - 1]
+    _point_view_to(view_dir, previous)
+    # Drop the rolled back version so a second rollback keeps going back in time
+    shutil.rmtree(current)
+    print(f"Rolled back {view_dir} to {previous}")
+    return previous
+
+def move_scenarios(
+    db_dir: str,
+    target_dir: str,
+    scenario_types: Dict[str, int],
+    max_per_type: int = 500,
+    dry_run: bool = False,
+    index_path: Optional[str] = None,
+    mode: str = "move",
+) -> ResamplePlan:
+    """
+    Move the smallest set of database files that brings every scenario type up to `max_per_type`
+    to a target directory. The plan is computed from per-log scenario counts and printed before
+    anything is moved.
+    :param db_dir: Directory containing `.db` files.
+    :param target_dir: Directory where the selected `.db` files will be moved.
     :param scenario_types: A dictionary of scenario types and their initial counts.
-    :param max_per_type: The maximum allowed files to move for each scenario type.
+    :param max_per_type: The number of scenarios wanted for each scenario type.
+    :param dry_run: Only compute and print the plan.
+    :param index_path: Optional path to a `ScenarioTagIndex` file to read per-log counts from.
+    :param mode: `move` relocates the files, `hardlink`/`symlink` build a view in `target_dir` with
+                 `build_resample_view` and leave `db_dir` untouched.
+    :return: The executed (or, with dry_run, proposed) plan.
     """
+    if mode not in ("move", "hardlink", "symlink"):
+        raise ValueError(f"Unsupported mode: {mode}")
+    log_counts = get_log_scenario_counts(db_dir, index_path)
+    log_sizes = {db_file: os.path.getsize(os.path.join(db_dir, db_file)) for db_file in log_counts}
+    deficits = {scenario_type: max_per_type - count for scenario_type, count in scenario_types.items()}
+    plan = plan_resample(log_counts, deficits, log_sizes)
+    plan.print_summary()
+    if dry_run:
+        return plan
+    if mode != "move":
+        build_resample_view(plan, db_dir, target_dir, link_type=mode)
+        return plan
+
     # Ensure the target directory exists
     os.makedirs(target_dir, exist_ok=True)
+    for db_file in plan.selected_logs:
+        db_path = os.path.join(db_dir, db_file)
+        target_path = os.path.join(target_dir, db_file)
+        if not os.path.exists(target_path):  # Avoid overwriting files
+            shutil.move(db_path, target_path)
+            print(f"Moved {db_path} to {target_path}")
+        else:
+            print(f"File {db_file} already exists in {target_dir}, skipping.")
 
-    # Dictionary to track how many times each scenario type has been moved
-    moved_counts: Dict[str, int] = defaultdict(int)
-
-    # Iterate over all `.db` files in the directory
-    for db_file in os.listdir(db_dir):
-        if db_file.endswith(".db"):  # Ensure we only process `.db` files
-            db_path = os.path.join(db_dir, db_file)
-            print(f"Processing {db_path}...")
-
-            # Check if the database contains any of the target scenario types
-            move_file = False
-            for scenario_type, _ in get_db_scenario_info(db_path):
-                if scenario_type in scenario_types:
-                    # Calculate remaining moves allowed for this scenario type
-                    remaining_moves = max_per_type - scenario_types[scenario_type] - moved_counts[scenario_type]
-                    if remaining_moves > 0:
-                        moved_counts[scenario_type] += 1  # Increment the move count for this type
-                        move_file = True
-                        print(f"Scenario type '{scenario_type}' moved {moved_counts[scenario_type]}/{max_per_type - scenario_types[scenario_type]}")
-                    else:
-                        print(f"Scenario type '{scenario_type}' reached its move limit ({max_per_type - scenario_types[scenario_type]}). Skipping.")
-
-            # Move the file if it contains at least one valid scenario type
-            if move_file:
-                target_path = os.path.join(target_dir, db_file)
-                if not os.path.exists(target_path):  # Avoid overwriting files
-                    shutil.move(db_path, target_path)
-                    print(f"Moved {db_path} to {target_path}")
-                else:
-                    print(f"File {db_file} already exists in {target_dir}, skipping.")
-
-    print(f"Total moved counts: {dict(moved_counts)}")
+    return plan
 
 def save_to_yaml(data: dict, output_file: str):
     """
@@ -202,9 +404,11 @@ if __name__ == "__main__":
 
     target_dir =  os.path.join(os.environ["NUPLAN_DATA_ROOT"], "nuplan-v1.1/resample")
     max_scenario_types = 500
-    move_scenarios(db_directory, target_dir, scenario_types, max_scenario_types)
+    # Only the logs moved out of trainval are re-read, the rest comes from the index
+    index_path = os.path.join(os.environ["NUPLAN_DATA_ROOT"], "nuplan-v1.1/scenario_tag_index.sqlite")
+    move_scenarios(db_directory, target_dir, scenario_types, max_scenario_types, index_path=index_path)
     # print("\nMove Scenario Counts:")
-    total_scenario_counts = aggregate_scenario_counts(db_directory)
+    total_scenario_counts = aggregate_scenario_counts(db_directory, index_path=index_path)
     # Print results
     print("\nAggregated Scenario Counts:")
     for scenario_type, count in sorted(total_scenario_counts.items(), key=lambda x: x[1], reverse=True):
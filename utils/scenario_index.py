@@ -0,0 +1,283 @@
+import os
+import sqlite3
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+from utils.db_connection import close_connection, execute_many
+
+
+class ScenarioTagIndex:
+    """
+    Consolidated on-disk index of the `scenario_tag` tables of many nuPlan `.db` logs.
+    Every indexed log is fingerprinted by its mtime and size, so rebuilding only re-reads logs that changed.
+    Rows are stored as (db_file, scenario_type, token, lidar_pc_token) in a single SQLite file, next to the
+    per-log scenario type counts so that global counts are a sum over logs rather than over tags.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS db_file (
+        id          INTEGER PRIMARY KEY,
+        db_path     TEXT NOT NULL UNIQUE,
+        db_dir      TEXT NOT NULL,
+        log_name    TEXT NOT NULL,
+        mtime       REAL NOT NULL,
+        size        INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS scenario_tag (
+        db_id           INTEGER NOT NULL REFERENCES db_file(id),
+        scenario_type   TEXT NOT NULL,
+        token           BLOB NOT NULL,
+        lidar_pc_token  BLOB NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS scenario_count (
+        db_id           INTEGER NOT NULL REFERENCES db_file(id),
+        scenario_type   TEXT NOT NULL,
+        cnt             INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_db_file_dir ON db_file(db_dir);
+    CREATE INDEX IF NOT EXISTS idx_scenario_count_db ON scenario_count(db_id);
+    CREATE INDEX IF NOT EXISTS idx_scenario_tag_type ON scenario_tag(scenario_type);
+    CREATE INDEX IF NOT EXISTS idx_scenario_tag_db ON scenario_tag(db_id);
+    """
+
+    def __init__(self, index_path: str):
+        """
+        Open (or create) the index file.
+        :param index_path: Path to the SQLite file holding the index.
+        """
+        self.index_path = index_path
+        self.connection = sqlite3.connect(index_path)
+        self.connection.executescript(self.SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _fingerprint(db_path: str) -> Tuple[float, int]:
+        stat = os.stat(db_path)
+        return stat.st_mtime, stat.st_size
+
+    @staticmethod
+    def _read_scenario_tags(db_path: str) -> List[Tuple[str, bytes, bytes]]:
+        query = """
+        SELECT  type,
+                token,
+                lidar_pc_token
+        FROM scenario_tag;
+        """
+        return [tuple(row) for row in execute_many(query, (), db_path)]
+
+    def index_db_file(self, db_path: str) -> bool:
+        """
+        Index a single `.db` file unless it is already indexed with the same mtime and size.
+        :param db_path: Path to the SQLite database file.
+        :return: True if the file was (re-)read, False if the stored rows were still valid.
+        """
+        db_path = os.path.abspath(db_path)
+        mtime, size = self._fingerprint(db_path)
+        row = self.connection.execute(
+            "SELECT id, mtime, size FROM db_file WHERE db_path = ?;", (db_path,)
+        ).fetchone()
+        if row is not None and row[1] == mtime and row[2] == size:
+            return False
+
+        # The log changed on disk, drop any immutable connection that still caches the old pages
+        close_connection(db_path)
+        rows = self._read_scenario_tags(db_path)
+        counts = defaultdict(int)
+        for scenario_type, _, _ in rows:
+            counts[scenario_type] += 1
+        with self.connection:
+            if row is not None:
+                self._delete_db_id(row[0])
+            cursor = self.connection.execute(
+                "INSERT INTO db_file (db_path, db_dir, log_name, mtime, size) VALUES (?, ?, ?, ?, ?);",
+                (db_path, os.path.dirname(db_path), os.path.splitext(os.path.basename(db_path))[0], mtime, size),
+            )
+            db_id = cursor.lastrowid
+            self.connection.executemany(
+                "INSERT INTO scenario_tag (db_id, scenario_type, token, lidar_pc_token) VALUES (?, ?, ?, ?);",
+                ((db_id, scenario_type, token, lidar_pc_token) for scenario_type, token, lidar_pc_token in rows),
+            )
+            self.connection.executemany(
+                "INSERT INTO scenario_count (db_id, scenario_type, cnt) VALUES (?, ?, ?);",
+                ((db_id, scenario_type, cnt) for scenario_type, cnt in counts.items()),
+            )
+        return True
+
+    def _delete_db_id(self, db_id: int):
+        self.connection.execute("DELETE FROM scenario_tag WHERE db_id = ?;", (db_id,))
+        self.connection.execute("DELETE FROM scenario_count WHERE db_id = ?;", (db_id,))
+        self.connection.execute("DELETE FROM db_file WHERE id = ?;", (db_id,))
+
+    def update(self, db_files: Iterable[str]) -> int:
+        """
+        Index several `.db` files, skipping the ones whose fingerprint did not change.
+        :param db_files: Paths to the SQLite database files.
+        :return: The number of files that were (re-)read.
+        """
+        num_indexed = 0
+        for db_file in db_files:
+            if self.index_db_file(db_file):
+                num_indexed += 1
+                print(f"Indexed {db_file}")
+        return num_indexed
+
+    def refresh(self, db_dir: str) -> Dict[str, List[str]]:
+        """
+        Bring the index of a directory up to date: read new and changed `.db` files and drop the logs
+        that were removed (e.g. relocated by `move_scenarios`). Unchanged logs are not opened.
+        :param db_dir: Directory containing the `.db` files.
+        :return: A dictionary with the `added`, `changed` and `removed` db file names.
+        """
+        db_dir = os.path.abspath(db_dir)
+        on_disk = {
+            os.path.join(db_dir, db_file) for db_file in os.listdir(db_dir) if db_file.endswith(".db")
+        }
+        indexed = {
+            db_path: db_id
+            for db_id, db_path in self.connection.execute("SELECT id, db_path FROM db_file WHERE db_dir = ?;", (db_dir,))
+        }
+
+        delta = {"added": [], "changed": [], "removed": []}
+        removed = sorted(set(indexed) - on_disk)
+        with self.connection:
+            for db_path in removed:
+                close_connection(db_path)
+                self._delete_db_id(indexed[db_path])
+                delta["removed"].append(os.path.basename(db_path))
+
+        for db_path in sorted(on_disk):
+            if self.index_db_file(db_path):
+                delta["changed" if db_path in indexed else "added"].append(os.path.basename(db_path))
+
+        print(
+            f"Refreshed index of {db_dir}: {len(delta['added'])} added, {len(delta['changed'])} changed, "
+            f"{len(delta['removed'])} removed, {len(on_disk) - len(delta['added']) - len(delta['changed'])} unchanged."
+        )
+        return delta
+
+    def build(self, db_dir: str) -> int:
+        """
+        Index all `.db` files in a directory.
+        :param db_dir: Directory containing the `.db` files.
+        :return: The number of files that were (re-)read.
+        """
+        delta = self.refresh(db_dir)
+        return len(delta["added"]) + len(delta["changed"])
+
+    def _dir_clause(self, db_dir: Optional[str]) -> Tuple[str, Tuple]:
+        if db_dir is None:
+            return "", ()
+        return "WHERE f.db_dir = ?", (os.path.abspath(db_dir),)
+
+    def get_scenario_counts(self, db_dir: Optional[str] = None) -> Dict[str, int]:
+        """
+        Get the total number of scenarios per scenario type.
+        :param db_dir: Only count logs located in this directory, all indexed logs if None.
+        :return: A dictionary with scenario types as keys and their total counts as values.
+        """
+        where, params = self._dir_clause(db_dir)
+        query = f"""
+        SELECT  sc.scenario_type,
+                SUM(sc.cnt) AS cnt
+        FROM scenario_count AS sc
+        INNER JOIN db_file AS f
+            ON f.id = sc.db_id
+        {where}
+        GROUP BY sc.scenario_type;
+        """
+        return {scenario_type: cnt for scenario_type, cnt in self.connection.execute(query, params)}
+
+    def get_log_scenario_counts(self, db_dir: Optional[str] = None) -> Dict[str, Dict[str, int]]:
+        """
+        Get the number of scenarios per scenario type for every log.
+        :param db_dir: Only include logs located in this directory, all indexed logs if None.
+        :return: A nested dictionary {db_file: {scenario_type: count}}, keyed by `.db` file name.
+        """
+        where, params = self._dir_clause(db_dir)
+        query = f"""
+        SELECT  f.db_path,
+                sc.scenario_type,
+                sc.cnt
+        FROM scenario_count AS sc
+        INNER JOIN db_file AS f
+            ON f.id = sc.db_id
+        {where};
+        """
+        log_counts = defaultdict(dict)
+        for db_path, scenario_type, cnt in self.connection.execute(query, params):
+            log_counts[os.path.basename(db_path)][scenario_type] = cnt
+        return dict(log_counts)
+
+    def get_scenario_info_from_all_dbs(self, db_dir: Optional[str] = None) -> Dict[str, Dict[str, List[str]]]:
+        """
+        Index-backed equivalent of `get_scenario_tokens.get_scenario_info_from_all_dbs`.
+        :param db_dir: Only include logs located in this directory, all indexed logs if None.
+        :return: A nested dictionary {db_file: {scenario_type: [scenario_tag tokens]}}.
+        """
+        where, params = self._dir_clause(db_dir)
+        query = f"""
+        SELECT  f.db_path,
+                st.scenario_type,
+                st.token
+        FROM scenario_tag AS st
+        INNER JOIN db_file AS f
+            ON f.id = st.db_id
+        {where}
+        ORDER BY f.db_path;
+        """
+        all_scenario_info = defaultdict(lambda: defaultdict(list))
+        for db_path, scenario_type, token in self.connection.execute(query, params):
+            all_scenario_info[os.path.basename(db_path)][scenario_type].append(token.hex())
+        return {db_file: dict(info) for db_file, info in all_scenario_info.items()}
+
+    def get_scenario_type_token_map(
+        self,
+        scenario_types: Optional[List[str]] = None,
+        db_dir: Optional[str] = None,
+        db_files: Optional[Iterable[str]] = None,
+    ) -> Dict[str, List[Tuple[str, str]]]:
+        """
+        Index-backed equivalent of `distribution.get_scenario_type_token_map`. All filters are applied in SQL.
+        :param scenario_types: Only return these scenario types, all types if None.
+        :param db_dir: Only include logs located in this directory, all indexed logs if None.
+        :param db_files: Only include these logs, all indexed logs if None.
+        :return: dictionary mapping scenario type to list of db/lidar_pc token pairs of that type.
+        """
+        conditions = []
+        params = []
+        if db_dir is not None:
+            conditions.append("f.db_dir = ?")
+            params.append(os.path.abspath(db_dir))
+        if scenario_types is not None:
+            conditions.append(f"st.scenario_type IN ({', '.join('?' * len(scenario_types))})")
+            params.extend(scenario_types)
+        if db_files is not None:
+            # A temporary table rather than an IN list, which would hit SQLite's parameter limit on large splits
+            self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS selected_db_file (db_path TEXT PRIMARY KEY);")
+            self.connection.execute("DELETE FROM temp.selected_db_file;")
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO temp.selected_db_file (db_path) VALUES (?);",
+                ((os.path.abspath(db_file),) for db_file in db_files),
+            )
+            conditions.append("f.db_path IN (SELECT db_path FROM temp.selected_db_file)")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = f"""
+        SELECT  st.scenario_type,
+                f.db_path,
+                st.lidar_pc_token
+        FROM scenario_tag AS st
+        INNER JOIN db_file AS f
+            ON f.id = st.db_id
+        {where};
+        """
+        available_scenario_types = defaultdict(list)
+        for scenario_type, db_path, lidar_pc_token in self.connection.execute(query, params):
+            available_scenario_types[scenario_type].append((db_path, lidar_pc_token.hex()))
+        return available_scenario_types
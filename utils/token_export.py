@@ -0,0 +1,195 @@
+import os
+from collections import defaultdict
+from typing import Dict, Generator, List, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils.db_connection import execute_batches, execute_one
+
+TOKEN_COLUMNS = ("token", "lidar_pc_token")
+# nuPlan tokens are 16 hex characters, i.e. 8 raw bytes
+TOKEN_NUM_BYTES = 8
+TOKEN_SCHEMA = pa.schema([
+    ("scenario_type", pa.dictionary(pa.int32(), pa.string())),
+    ("db_file", pa.dictionary(pa.int32(), pa.string())),
+    ("token", pa.binary(TOKEN_NUM_BYTES)),
+])
+
+
+def _scenario_tag_query(token_column: str) -> str:
+    if token_column not in TOKEN_COLUMNS:
+        raise ValueError(f"token_column must be one of {TOKEN_COLUMNS}, got '{token_column}'.")
+    return f"""
+    SELECT  type,
+            {token_column}
+    FROM scenario_tag;
+    """
+
+
+def iter_scenario_token_batches(
+    db_file: str, token_column: str = "lidar_pc_token", batch_size: int = 100_000
+) -> Generator[List[Tuple[str, bytes]], None, None]:
+    """
+    Stream the (scenario_type, token) rows of a single database file in batches, tokens kept as raw bytes.
+    :param db_file: Path to the SQLite database file.
+    :param token_column: Which `scenario_tag` token to export, `lidar_pc_token` (the scenario token) or `token`.
+    :param batch_size: Maximum number of rows per batch.
+    :return: A generator of lists of (scenario_type, token) tuples.
+    """
+    for rows in execute_batches(_scenario_tag_query(token_column), (), db_file, batch_size):
+        yield [(scenario_type, token) for scenario_type, token in rows]
+
+
+def export_scenario_tokens(
+    db_files: List[str], output_path: str, token_column: str = "lidar_pc_token", batch_size: int = 100_000
+) -> int:
+    """
+    Stream (scenario_type, db_file, token) rows of many database files into a Parquet file.
+    Every batch becomes one row group, so memory use is bounded by `batch_size` regardless of the dataset size.
+    Scenario types and db files are dictionary encoded and tokens are stored as fixed-size binary.
+    :param db_files: db files to export.
+    :param output_path: Path of the Parquet file to write.
+    :param token_column: Which `scenario_tag` token to export, `lidar_pc_token` (the scenario token) or `token`.
+    :param batch_size: Maximum number of rows per row group.
+    :return: The number of exported rows.
+    """
+    num_rows = 0
+    with pq.ParquetWriter(output_path, TOKEN_SCHEMA) as writer:
+        for db_file in db_files:
+            db_name = os.path.basename(db_file)
+            for rows in iter_scenario_token_batches(db_file, token_column, batch_size):
+                scenario_types, tokens = zip(*rows)
+                batch = pa.record_batch([
+                    pa.array(scenario_types, pa.string()).dictionary_encode(),
+                    pa.DictionaryArray.from_arrays(
+                        pa.array(np.zeros(len(rows), dtype=np.int32)), pa.array([db_name], pa.string())
+                    ),
+                    pa.array(tokens, pa.binary(TOKEN_NUM_BYTES)),
+                ], schema=TOKEN_SCHEMA)
+                writer.write_batch(batch)
+                num_rows += len(rows)
+            print(f"Exported {db_file}")
+    print(f"Exported {num_rows} scenario tokens to {output_path}")
+    return num_rows
+
+
+class CompactTokenTable:
+    """
+    Columnar in-memory table of scenario tokens: categorical type/db codes and a fixed-width bytes array.
+    Each scenario costs 14 bytes instead of a Python str per token plus a list slot.
+    """
+
+    def __init__(self, scenario_types: List[str], db_files: List[str], type_codes: np.ndarray,
+                 db_codes: np.ndarray, tokens: np.ndarray):
+        """
+        :param scenario_types: Categories referenced by `type_codes`.
+        :param db_files: Categories referenced by `db_codes`, `.db` file names without their directory.
+        :param type_codes: uint16 array with the scenario type code of every row.
+        :param db_codes: uint32 array with the db file code of every row.
+        :param tokens: uint8 array of shape (num_rows, TOKEN_NUM_BYTES) with the raw token of every row.
+        """
+        self.scenario_types = scenario_types
+        self.db_files = db_files
+        self.type_codes = type_codes
+        self.db_codes = db_codes
+        self.tokens = tokens
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    @classmethod
+    def from_db_files(cls, db_files: List[str], token_column: str = "lidar_pc_token",
+                      batch_size: int = 100_000) -> "CompactTokenTable":
+        """
+        Build the table from database files. Row counts are queried first so that the arrays are allocated
+        once at their final size and filled batch by batch.
+        :param db_files: db files to read.
+        :param token_column: Which `scenario_tag` token to keep, `lidar_pc_token` (the scenario token) or `token`.
+        :param batch_size: Number of rows fetched from SQLite at a time.
+        :return: The filled table.
+        """
+        num_rows = sum(execute_one("SELECT COUNT(*) FROM scenario_tag;", (), db_file)[0] for db_file in db_files)
+
+        type_codes = np.empty(num_rows, dtype=np.uint16)
+        db_codes = np.empty(num_rows, dtype=np.uint32)
+        tokens = np.empty((num_rows, TOKEN_NUM_BYTES), dtype=np.uint8)
+        scenario_type_codes: Dict[str, int] = {}
+
+        start = 0
+        for db_code, db_file in enumerate(db_files):
+            for rows in iter_scenario_token_batches(db_file, token_column, batch_size):
+                stop = start + len(rows)
+                type_codes[start:stop] = [
+                    scenario_type_codes.setdefault(scenario_type, len(scenario_type_codes))
+                    for scenario_type, _ in rows
+                ]
+                raw_tokens = b"".join(token for _, token in rows)
+                tokens[start:stop] = np.frombuffer(raw_tokens, dtype=np.uint8).reshape(-1, TOKEN_NUM_BYTES)
+                db_codes[start:stop] = db_code
+                start = stop
+
+        # The files may have changed between counting and reading
+        # Logs are identified by file name, as in the files written by `export_scenario_tokens`
+        db_names = [os.path.basename(db_file) for db_file in db_files]
+        return cls(list(scenario_type_codes), db_names, type_codes[:start], db_codes[:start], tokens[:start])
+
+    @classmethod
+    def from_parquet(cls, path: str) -> "CompactTokenTable":
+        """
+        Load a file written by `export_scenario_tokens` without materializing any per-token Python object.
+        :param path: Path of the Parquet file.
+        :return: The table.
+        """
+        table = pq.read_table(path).unify_dictionaries().combine_chunks()
+        if table.num_rows == 0:
+            empty_tokens = np.empty((0, TOKEN_NUM_BYTES), dtype=np.uint8)
+            return cls([], [], np.empty(0, dtype=np.uint16), np.empty(0, dtype=np.uint32), empty_tokens)
+
+        scenario_type = table.column("scenario_type").chunk(0)
+        db_file = table.column("db_file").chunk(0)
+        token = table.column("token").chunk(0)
+        tokens = np.frombuffer(
+            token.buffers()[1],
+            dtype=np.uint8,
+            count=len(token) * TOKEN_NUM_BYTES,
+            offset=token.offset * TOKEN_NUM_BYTES,
+        ).reshape(-1, TOKEN_NUM_BYTES)
+        return cls(
+            scenario_type.dictionary.to_pylist(),
+            db_file.dictionary.to_pylist(),
+            scenario_type.indices.to_numpy().astype(np.uint16),
+            db_file.indices.to_numpy().astype(np.uint32),
+            tokens.copy(),
+        )
+
+    def get_scenario_counts(self) -> Dict[str, int]:
+        """
+        :return: A dictionary with scenario types as keys and their total counts as values.
+        """
+        counts = np.bincount(self.type_codes, minlength=len(self.scenario_types))
+        return {scenario_type: int(count) for scenario_type, count in zip(self.scenario_types, counts)}
+
+    def get_tokens(self, scenario_type: str) -> List[str]:
+        """
+        Get the hex tokens of one scenario type, only this slice is converted to Python strings.
+        :param scenario_type: The scenario type to select.
+        :return: List of hex tokens.
+        """
+        if scenario_type not in self.scenario_types:
+            return []
+        mask = self.type_codes == self.scenario_types.index(scenario_type)
+        return [token.tobytes().hex() for token in self.tokens[mask]]
+
+    def get_scenario_type_token_map(self) -> Dict[str, List[Tuple[str, str]]]:
+        """
+        Same result as `distribution.get_scenario_type_token_map`, for callers that need the full dict.
+        :return: dictionary mapping scenario type to list of db file name/token pairs of that type.
+        """
+        available_scenario_types = defaultdict(list)
+        for type_code, db_code, token in zip(self.type_codes, self.db_codes, self.tokens):
+            available_scenario_types[self.scenario_types[type_code]].append(
+                (self.db_files[db_code], token.tobytes().hex())
+            )
+        return available_scenario_types